@@ -0,0 +1,151 @@
+""" Measures the throughput of the Python hot paths on synthetic data: the 5' fix, ModStop counting, loading of
+CountMod files, the statistical tests and, if matplotlib is available, histogram drawing.
+
+The numbers are meant to be compared across versions, so the data is generated from a fixed seed.
+
+Usage: python benchmarks/bench_hotpaths.py [--genes N] [--reads N] [--histograms N] [--seed N]
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import synthetic
+from lib import CountModStore
+from lib.Sample import Sample
+from lib.StatMagician import StatMagician
+from lib.routines.StatRoutine import StatRoutine
+
+
+def timed(function):
+    """ Runs function with its progress messages silenced. Returns the elapsed time and the result. """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function()
+        return time.perf_counter() - start, result
+
+
+def report(name, seconds, amount, unit):
+    print("{:<34} {:>10.3f} s {:>14,.0f} {}/s".format(name, seconds, amount / seconds, unit))
+
+
+def count_lines(filename):
+    with open(filename) as fh:
+        return sum(1 for line in fh)
+
+
+def bench_fix(directory, sample):
+    source = os.path.join(directory, "Aligned-syn_sample.sam")
+    lines = count_lines(source)
+
+    seconds, result = timed(lambda: sample.wrapFix(
+        source,
+        os.path.join(directory, "5pFixed-syn_sample.sam"),
+        os.path.join(directory, "5pMisMatch-syn_sample.sam")
+    ))
+    report("fix (wrapFix)", seconds, lines, "lines")
+
+
+def bench_modcount(directory, sample):
+    lines = count_lines(sample.getFileName("Intersect", ".tab", True))
+
+    for parser in ("line", "bulk"):
+        sample.settings["ModCountParser"] = parser
+        seconds, result = timed(sample.runModCount)
+        report("runModCount (%s)" % parser, seconds, lines, "lines")
+
+
+def bench_load(pairs):
+    routine = StatRoutine()
+    files = [filename for pair in pairs for filename in pair]
+
+    for extension in (CountModStore.TEXT_EXTENSION, CountModStore.BINARY_EXTENSION):
+        names = [os.path.splitext(filename)[0] + extension for filename in files]
+
+        seconds, dataList = timed(lambda: [routine.readSingleDataFile(name) for name in names])
+        positions = sum(gene.length for data in dataList for gene in data.values())
+        report("readSingleDataFile (%s)" % extension, seconds, positions, "positions")
+
+    return dataList
+
+
+def bench_stat(dataList):
+    positions = sum(gene.length for gene in dataList[0].values())
+
+    for engine in ("scalar", "vectorized"):
+        magic = StatMagician(dataList, 0.05, 1.5, engine)
+        seconds, result = timed(magic.run)
+        report("StatMagician.run (%s)" % engine, seconds, positions, "positions")
+
+
+def bench_histogram(directory, dataList, count):
+    try:
+        from lib.routines.HistoRoutine import HistogramRenderer, HistoRoutine
+
+        # The backend is only loaded once the first figure is created
+        HistogramRenderer().close()
+    except (ImportError, ValueError) as e:
+        print("{:<34} skipped ({})".format("draw_histogram", e))
+        return
+
+    keys = list(dataList[0].keys())[:count]
+
+    routine = HistoRoutine()
+    routine.dataList = [{key: data[key] for key in keys} for data in dataList]
+    routine.fileSearchPath = directory
+    routine.geneFilter = ""
+
+    seconds, result = timed(routine.draw_histogram)
+    report("draw_histogram", seconds, len(keys), "genes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the throughput of the Python hot paths")
+    parser.add_argument("--genes", type=int, default=200)
+    parser.add_argument("--reads", type=int, default=200000)
+    parser.add_argument("--histograms", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="quralk-bench-")
+
+    try:
+        genes = synthetic.make_genes(args.genes, args.seed)
+        reads = synthetic.make_reads(genes, args.reads, args.seed)
+        annotation = os.path.join(directory, "annotation.gff")
+
+        synthetic.write_gff(annotation, genes)
+        synthetic.write_sam(os.path.join(directory, "Aligned-syn_sample.sam"), genes, reads, args.seed)
+        synthetic.write_intersect(os.path.join(directory, "Intersect-syn_sample.tab"), genes, reads)
+        pairs = synthetic.write_countmod_set(directory, genes, 2, args.seed, CountModStore.TEXT_EXTENSION)
+        synthetic.write_countmod_set(directory, genes, 2, args.seed, CountModStore.BINARY_EXTENSION)
+
+        settings = synthetic.Settings(
+            InputDirectory=directory,
+            OutputDirectory=directory,
+            ReferenceGenomFile="syn",
+            GeneAnnotationFile=annotation,
+            ModCountParser="line",
+            CountModFormat="text",
+        )
+        sample = Sample("sample", settings)
+
+        print("{} genes, {} reads\n".format(len(genes), len(reads)))
+
+        bench_fix(directory, sample)
+        bench_modcount(directory, sample)
+        dataList = bench_load(pairs)
+        bench_stat(dataList)
+        bench_histogram(directory, dataList, args.histograms)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
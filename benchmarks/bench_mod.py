@@ -0,0 +1,94 @@
+""" Times a complete mod run on synthetic samples, using the stand-in tools of benchmarks/fakebin instead of cutadapt,
+bowtie, samtools and intersectBed. The stand-ins are simple, so the timing shows the cost of the orchestration and of
+the Python stages rather than that of the real tools.
+
+The run happens in a temporary home directory, as the configuration is read from ~/QURAlkData. Configuration keys
+can be overridden with --set, eg. --set Scheduler=stage --set CountEngine=native.
+
+Usage: python benchmarks/bench_mod.py [--samples N] [--reads N] [--genes N] [--set Key=Value ...] [--keep]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import synthetic
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, "..")
+
+
+def write_config(filename, settings):
+    with open(filename, "w") as fh:
+        for key in settings:
+            fh.write("%s = %s\n" % (key, settings[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times a mod run with stand-in tools")
+    parser.add_argument("--samples", type=int, default=4)
+    parser.add_argument("--reads", type=int, default=50000)
+    parser.add_argument("--genes", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory")
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix="quralk-mod-")
+    data = os.path.join(home, "QURAlkData")
+
+    try:
+        for directory in ("Input", "Output", "GenRef", "GenAnnot"):
+            os.makedirs(os.path.join(data, directory))
+
+        genes = synthetic.make_genes(args.genes, args.seed)
+        synthetic.write_gff(os.path.join(data, "GenAnnot", "annotation.gff"), genes)
+
+        for i in range(args.samples):
+            reads = synthetic.make_reads(genes, args.reads, args.seed + i)
+            synthetic.write_fastq(os.path.join(data, "Input", "sample%d.fastq.gz" % (i + 1)), reads, args.seed + i)
+
+        settings = {
+            "ReferenceGenomPath": os.path.join(data, "GenRef"),
+            "ReferenceGenomFile": "syn",
+            "GeneAnnotationFile": os.path.join(data, "GenAnnot", "annotation.gff"),
+            "SequenceAdapter5": "^" + synthetic.ADAPTER5,
+            "SequenceAdapter3": synthetic.ADAPTER3,
+            "OutputDirectory": os.path.join(data, "Output"),
+            "InputDirectory": os.path.join(data, "Input"),
+            "MaxPythonThreads": 4,
+            "MaxBowtieThreads": 2,
+        }
+        for option in args.set:
+            key, value = option.split("=", 1)
+            settings[key.strip()] = value.strip()
+
+        write_config(os.path.join(data, "mod_config.ini"), settings)
+
+        environment = dict(os.environ)
+        environment["HOME"] = home
+        environment["PATH"] = os.path.join(BENCHMARKS, "fakebin") + os.pathsep + environment["PATH"]
+
+        start = time.perf_counter()
+        status = subprocess.call([sys.executable, os.path.join(ROOT, "quralk-pipe.py"), "mod"], env=environment)
+        seconds = time.perf_counter() - start
+
+        total = args.samples * args.reads
+        print("\nmod: {} samples, {} reads in {:.2f} s ({:,.0f} reads/s), exit status {}".format(
+            args.samples, total, seconds, total / seconds, status))
+        if args.keep:
+            print("Kept %s" % home)
+
+        sys.exit(status)
+    finally:
+        if not args.keep:
+            shutil.rmtree(home)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+""" Compares how the threshold and rank p-value adjustments of StatMagician scale with gene length.
+
+Usage: python benchmarks/bench_padjust.py [length ...]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib.GeneModCount import GeneModCount2
+from lib.StatMagician import StatMagician
+
+DEFAULT_LENGTHS = [500, 1000, 2000, 4000, 8000, 16000]
+
+
+def make_gene(length, seed=0):
+    """ Creates a gene with random test results. A tenth of the positions gets a tiny p-value so that the
+    threshold method has significant positions to rank. """
+    rng = random.Random(seed)
+    gene = GeneModCount2("bench", "chrI", "+", "gene", 1, length)
+    pvalues = [rng.random() * (1e-6 if rng.random() < 0.1 else 1.0) for i in range(length)]
+    gene.testArray = [[0.0, p, "NA", 1.0, 1.0, 1.0] for p in pvalues]
+
+    return gene, pvalues
+
+
+def time_method(method, length, repeats=3):
+    best = None
+
+    for i in range(repeats):
+        gene, pvalues = make_gene(length)
+        magic = StatMagician([{}, {}], 0.05, 1.5, adjustMethod=method)
+
+        start = time.perf_counter()
+        magic.adjustPvalues(gene, pvalues)
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main(lengths):
+    print("{:>8}  {:>14}  {:>14}  {:>8}".format("length", "threshold [s]", "rank [s]", "speedup"))
+
+    for length in lengths:
+        threshold = time_method("threshold", length)
+        rank = time_method("rank", length)
+        print("{:>8}  {:>14.6f}  {:>14.6f}  {:>7.1f}x".format(length, threshold, rank, threshold / rank))
+
+
+if __name__ == "__main__":
+    main([int(x) for x in sys.argv[1:]] or DEFAULT_LENGTHS)
@@ -0,0 +1,56 @@
+""" Measures the startup time of the command line: quralk-pipe help, and help <routine> for every routine, which
+imports the routine the way selecting it for a run does, without running it.
+
+Every command is started a few times as a new process; the fastest and the median wall time are reported.
+
+Usage: python benchmarks/bench_startup.py [--repeat N]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib.Routines import list_routines
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def time_command(arguments, repeat):
+    """ Runs quralk-pipe with arguments repeat times. Returns the wall times and the last exit status. """
+    times = []
+    status = 0
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        status = subprocess.call([sys.executable, os.path.join(ROOT, "quralk-pipe.py")] + arguments,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+
+    return times, status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the startup time of the command line")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    commands = [["help"]] + [["help", routine] for routine in list_routines() if routine != "help"]
+
+    print("{:<24} {:>10} {:>10}".format("command", "min [s]", "median [s]"))
+
+    for arguments in commands:
+        times, status = time_command(arguments, args.repeat)
+        name = " ".join(arguments)
+
+        if status != 0:
+            print("{:<24} failed with exit status {}".format(name, status))
+        else:
+            print("{:<24} {:>10.3f} {:>10.3f}".format(name, min(times), statistics.median(times)))
+
+
+if __name__ == "__main__":
+    main()
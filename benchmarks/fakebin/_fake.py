@@ -0,0 +1,57 @@
+""" Shared helpers of the stand-in executables. They only mimic the command lines QURAlk-pipe uses. """
+import gzip
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import synthetic
+
+
+def open_input(filename, mode="rt"):
+    """ Opens a plain or gzipped file, or stdin for "-". """
+    if filename == "-":
+        return sys.stdin.buffer if "b" in mode else sys.stdin
+    elif filename.endswith(".gz"):
+        return gzip.open(filename, mode)
+    else:
+        return open(filename, mode)
+
+
+def open_output(filename, mode="wt"):
+    """ Opens a plain or gzipped file for writing, or stdout for "-" and None. """
+    if filename is None or filename == "-":
+        return sys.stdout.buffer if "b" in mode else sys.stdout
+    elif filename.endswith(".gz"):
+        return gzip.open(filename, mode, compresslevel=1)
+    else:
+        return open(filename, mode)
+
+
+def read_fastq(fh):
+    """ Yields (name, seq, qual) of a fastq stream. """
+    while True:
+        name = fh.readline()
+        if not name:
+            return
+        seq = fh.readline().rstrip("\n")
+        fh.readline()
+        qual = fh.readline().rstrip("\n")
+        yield name[1:].rstrip("\n"), seq, qual
+
+
+def sam_lines(fh):
+    """ Yields the alignment lines of a SAM stream, skipping the header. """
+    for line in fh:
+        if not line.startswith("@"):
+            yield line
+
+
+def reference_length(cigar):
+    """ Number of reference bases covered by a CIGAR string. """
+    return sum(int(x) for x in re.findall(r"(\d+)[MDN=X]", cigar))
+
+
+def flag(line):
+    return int(line.split("\t", 2)[1])
@@ -0,0 +1,275 @@
+""" Generates reproducible synthetic data for the benchmarks: gene annotations (GFF and BED), aligned reads (SAM),
+Intersect .tab files, CountMod files and raw .fastq.gz samples.
+
+Every read name carries the alignment the read has been drawn from (syn<i>:<chrom>:<strand>:<pos>:<mismatches>),
+which is what the stand-in bowtie in benchmarks/fakebin uses to "align" it.
+
+Usage: python benchmarks/synthetic.py <directory> [--genes N] [--reads N] [--replicates N] [--seed N]
+"""
+import argparse
+import bisect
+import gzip
+import os
+import random
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib import CountModStore
+from lib.GeneModCount import GeneModCount2
+
+CHROMOSOMES = ["chrI", "chrII", "chrIII", "chrIV"]
+BASES = "ACGT"
+
+# Default adapters of the mod configuration
+ADAPTER5 = "ATCGTAGGCACCTGAAA"
+ADAPTER3 = "CTGTAGGCACCATCAAT"
+
+
+class Settings(dict):
+    """ Minimal stand-in for ModConfiguration and StatConfiguration. """
+    def get(self, key):
+        return self[key]
+
+
+class Gene:
+    """ A synthetic gene. start and end are 1-based and inclusive, like in GFF files. """
+    def __init__(self, name, chrom, strand, start, end):
+        self.name = name
+        self.chrom = chrom
+        self.strand = strand
+        self.start = start
+        self.end = end
+
+    @property
+    def length(self):
+        return self.end - self.start + 1
+
+
+class Read:
+    """ A synthetic alignment. pos is the 1-based leftmost position, mismatches the number of 5' mismatches. """
+    def __init__(self, name, chrom, strand, pos, length, mismatches):
+        self.name = name
+        self.chrom = chrom
+        self.strand = strand
+        self.pos = pos
+        self.length = length
+        self.mismatches = mismatches
+
+
+def make_genes(count, seed=0, minLength=300, maxLength=3000):
+    """ Places count non-overlapping genes on a few chromosomes. """
+    rng = random.Random(seed)
+    genes = []
+    ends = {chrom: 0 for chrom in CHROMOSOMES}
+
+    for i in range(count):
+        chrom = CHROMOSOMES[i % len(CHROMOSOMES)]
+        start = ends[chrom] + rng.randint(50, 500)
+        end = start + rng.randint(minLength, maxLength) - 1
+        ends[chrom] = end
+        genes.append(Gene("GEN%05d" % i, chrom, rng.choice("+-"), start, end))
+
+    return genes
+
+
+def make_reads(genes, count, seed=0, mismatchRate=0.1):
+    """ Draws count reads that lie strictly inside the genes, genes being picked proportionally to their length. """
+    rng = random.Random(seed)
+    cumulative = []
+    total = 0
+    for gene in genes:
+        total += gene.length
+        cumulative.append(total)
+
+    reads = []
+    for i in range(count):
+        gene = genes[bisect.bisect_right(cumulative, rng.randrange(total))]
+        length = rng.randint(30, 51)
+        pos = rng.randint(gene.start + 1, max(gene.start + 1, gene.end - length - 1))
+        mismatches = rng.choice((1, 1, 2)) if rng.random() < mismatchRate else 0
+        reads.append(Read("syn%d" % i, gene.chrom, gene.strand, pos, length, mismatches))
+
+    return reads
+
+
+def read_name(read):
+    return "%s:%s:%s:%d:%d" % (read.name, read.chrom, read.strand, read.pos, read.mismatches)
+
+
+def parse_read_name(name):
+    """ Returns (chrom, strand, pos, mismatches) encoded in a read name, or None for foreign reads. """
+    fields = name.split(":")
+    if len(fields) != 5:
+        return None
+    return fields[1], fields[2], int(fields[3]), int(fields[4])
+
+
+def md_tag(length, strand, mismatches):
+    """ MD tag with mismatches at the 5' end of the read, the way fivePrimeFix expects it. """
+    if mismatches == 0:
+        return "MD:Z:%d" % length
+    elif strand == "+":
+        return "MD:Z:" + "0A" * mismatches + str(length - mismatches)
+    else:
+        return "MD:Z:" + str(length - mismatches) + "A0" * mismatches
+
+
+def sam_record(name, chrom, strand, pos, seq, qual, mismatches):
+    """ Formats a bowtie-like SAM line. """
+    flag = 0 if strand == "+" else 16
+    return "%s\t%d\t%s\t%d\t255\t%dM\t*\t0\t0\t%s\t%s\tXA:i:%d\t%s\tNM:i:%d\n" % (
+        name, flag, chrom, pos, len(seq), seq, qual, mismatches, md_tag(len(seq), strand, mismatches), mismatches)
+
+
+def sam_header(genes):
+    ends = {}
+    for gene in genes:
+        ends[gene.chrom] = max(ends.get(gene.chrom, 0), gene.end)
+    return "@HD\tVN:1.0\tSO:unsorted\n" + "".join("@SQ\tSN:%s\tLN:%d\n" % (c, ends[c] + 1000) for c in sorted(ends))
+
+
+def write_gff(filename, genes):
+    with open(filename, "w") as fh:
+        fh.write("##gff-version 3\n")
+        for gene in genes:
+            fh.write("%s\tsynthetic\tgene\t%d\t%d\t.\t%s\t.\tID=%s;Name=%s\n" % (
+                gene.chrom, gene.start, gene.end, gene.strand, gene.name, gene.name))
+
+
+def write_bed(filename, genes):
+    with open(filename, "w") as fh:
+        for gene in genes:
+            fh.write("%s\t%d\t%d\t%s\t0\t%s\n" % (gene.chrom, gene.start - 1, gene.end, gene.name, gene.strand))
+
+
+def write_sam(filename, genes, reads, seed=0):
+    rng = random.Random(seed)
+
+    with open(filename, "w") as fh:
+        fh.write(sam_header(genes))
+        for read in reads:
+            seq = "".join(rng.choice(BASES) for i in range(read.length))
+            fh.write(sam_record(read_name(read), read.chrom, read.strand, read.pos, seq, "I" * read.length,
+                                read.mismatches))
+
+
+def write_intersect(filename, genes, reads, annotationType="gff"):
+    """ Writes reads the way runIntersect leaves them: intersectBed output reduced to nine columns by awk. """
+    index = {}
+    for gene in sorted(genes, key=lambda gene: gene.start):
+        index.setdefault((gene.chrom, gene.strand), ([], []))
+        index[(gene.chrom, gene.strand)][0].append(gene.start)
+        index[(gene.chrom, gene.strand)][1].append(gene)
+
+    with open(filename, "w") as fh:
+        for read in reads:
+            starts, candidates = index.get((read.chrom, read.strand), ([], []))
+            i = bisect.bisect_right(starts, read.pos) - 1
+            if i < 0:
+                continue
+            gene = candidates[i]
+
+            if annotationType == "gff":
+                fh.write("%s\t%d\t%d\t%s\t%s\tgene\t%d\t%d\t%s\n" % (
+                    read.chrom, read.pos - 1, read.pos - 1 + read.length, read_name(read), read.strand,
+                    gene.start, gene.end, gene.name))
+            else:
+                fh.write("%s\t%d\t%d\t%s\t%s\tNA\t%d\t%d\t%s\n" % (
+                    read.chrom, read.pos - 1, read.pos - 1 + read.length, read_name(read), read.strand,
+                    gene.start - 1, gene.end, gene.name))
+
+
+def write_countmod(filename, genes, seed=0, depth=5.0, signal=None):
+    """ Writes a CountMod file (.tab or .cmb) with Poisson counts. signal maps a gene name to an array that is added
+    to its counts, eg. to make treated samples differ from controls. """
+    rng = np.random.RandomState(seed)
+    stored = {}
+
+    for gene in genes:
+        counts = rng.poisson(depth, gene.length)
+        if signal is not None and gene.name in signal:
+            counts = counts + signal[gene.name]
+
+        entry = GeneModCount2(gene.name, gene.chrom, gene.strand, "gene", gene.start, gene.end)
+        entry.countArray = counts.tolist()
+        entry.prepare_description()
+        stored["%s_%d_%d" % (gene.name, gene.start, gene.end)] = entry
+
+    CountModStore.write(filename, stored)
+
+
+def make_signal(genes, seed=0, fraction=0.01, strength=40):
+    """ Picks a fraction of all positions and returns extra counts for them, per gene. """
+    rng = np.random.RandomState(seed)
+    signal = {}
+
+    for gene in genes:
+        extra = np.zeros(gene.length, np.int64)
+        hits = rng.random_sample(gene.length) < fraction
+        extra[hits] = strength
+        signal[gene.name] = extra
+
+    return signal
+
+
+def write_countmod_set(directory, genes, replicates=2, seed=0, extension=".tab"):
+    """ Writes replicates pairs of treated and control CountMod files. Returns the (treated, control) filenames. """
+    signal = make_signal(genes, seed)
+    pairs = []
+
+    for i in range(replicates):
+        treated = os.path.join(directory, "CountMod-syn_treated%d%s" % (i + 1, extension))
+        control = os.path.join(directory, "CountMod-syn_control%d%s" % (i + 1, extension))
+        write_countmod(treated, genes, seed + 2 * i + 1, signal=signal)
+        write_countmod(control, genes, seed + 2 * i + 2)
+        pairs.append((treated, control))
+
+    return pairs
+
+
+def write_fastq(filename, reads, seed=0, adaptStopRate=0.3):
+    """ Writes the raw reads of a sample as .fastq.gz. Every read ends in the 3' adapter; a share of them starts with
+    the 5' adapter and becomes an adapter stop, the others are mod stops. """
+    rng = random.Random(seed)
+
+    with gzip.open(filename, "wt", compresslevel=1) as fh:
+        for read in reads:
+            seq = "".join(rng.choice(BASES) for i in range(read.length))
+            if rng.random() < adaptStopRate:
+                seq = ADAPTER5 + seq
+            seq += ADAPTER3
+            fh.write("@%s\n%s\n+\n%s\n" % (read_name(read), seq, "I" * len(seq)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates synthetic QURAlk-pipe data")
+    parser.add_argument("directory")
+    parser.add_argument("--genes", type=int, default=200)
+    parser.add_argument("--reads", type=int, default=100000)
+    parser.add_argument("--replicates", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.directory):
+        os.makedirs(args.directory)
+
+    genes = make_genes(args.genes, args.seed)
+    reads = make_reads(genes, args.reads, args.seed)
+
+    write_gff(os.path.join(args.directory, "annotation.gff"), genes)
+    write_bed(os.path.join(args.directory, "annotation.bed"), genes)
+    write_sam(os.path.join(args.directory, "Aligned-syn_sample.sam"), genes, reads, args.seed)
+    write_intersect(os.path.join(args.directory, "Intersect-syn_sample.tab"), genes, reads)
+    write_fastq(os.path.join(args.directory, "sample.fastq.gz"), reads, args.seed)
+
+    for extension in (CountModStore.TEXT_EXTENSION, CountModStore.BINARY_EXTENSION):
+        write_countmod_set(args.directory, genes, args.replicates, args.seed, extension)
+
+    print("Written %d genes and %d reads to %s" % (len(genes), len(reads), args.directory))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+# Version of the compiled annotation cache, raise it when the cached arrays change
+CACHE_VERSION = 1
+CACHE_FIELDS = ["names", "types", "chromosomes", "strands", "starts", "ends"]
+
+# Annotations loaded by this process, shared by all samples of a run
+loaded = {}
+loadedLock = threading.Lock()
+
+
+def annotationType(filename):
+    """ Returns the format of a gene annotation file, judging by its file extension. """
+    if filename.endswith(".gff"):
+        return "gff"
+    elif filename.endswith(".bed"):
+        return "bed"
+    else:
+        raise Exception("Can't determine gen annotation file format of %s" % filename)
+
+
+def fileHash(filename):
+    sha1 = hashlib.sha1()
+
+    with open(filename, "rb") as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b""):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+def cacheFilename(filename, directory):
+    """ Returns the name of the compiled cache of an annotation file. The path hash keeps annotations with the same
+    name apart. """
+    path = os.path.abspath(filename)
+    return os.path.join(directory, "AnnotationCache-%s-%s.npz" % (
+        os.path.basename(filename), hashlib.sha1(path.encode("utf-8")).hexdigest()[:8]))
+
+
+def bedFilename(filename, directory):
+    """ Returns the name of the BED6 file compiled next to the cache of a GFF annotation. """
+    return cacheFilename(filename, directory)[:-len(".npz")] + ".bed"
+
+
+def annotationKey(filename, contentHash=None):
+    """ Returns the cache key of an annotation file: path, size, modification time and content hash. """
+    stat = os.stat(filename)
+    return [CACHE_VERSION, os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, contentHash]
+
+
+def loadAnnotation(filename, cacheDirectory=None):
+    """ Returns the AnnotationIndex of filename. It is built once per process, and compiled into a cache in
+    cacheDirectory that later runs reuse as long as the annotation has not changed. """
+    with loadedLock:
+        key = annotationKey(filename)
+        if filename in loaded and loaded[filename][0] == key:
+            return loaded[filename][1]
+
+        if cacheDirectory is None:
+            annotation = AnnotationIndex(filename)
+        else:
+            annotation = readCache(filename, cacheDirectory)
+            if annotation is None:
+                annotation = AnnotationIndex(filename)
+                try:
+                    writeCache(annotation, cacheDirectory)
+                except OSError as e:
+                    print("[Warning] Could not write the annotation cache: %s" % (e,))
+
+        loaded[filename] = (key, annotation)
+        return annotation
+
+
+def intersectAnnotation(filename, cacheDirectory):
+    """ Returns the annotation file to pass to intersectBed. A GFF annotation is replaced by its compiled BED6, which
+    holds the ID as the name and the feature type as the score, so the attributes need not be split for every read. """
+    if annotationType(filename) != "gff":
+        return filename
+
+    annotation = loadAnnotation(filename, cacheDirectory)
+
+    with loadedLock:
+        # The BED6 is written together with the cache, so it is only out of date if the cache could not be written
+        if bedKey(filename, cacheDirectory)[:4] != annotationKey(filename)[:4]:
+            writeBed(annotation, cacheDirectory, annotationKey(filename, fileHash(filename)))
+
+    return bedFilename(filename, cacheDirectory)
+
+
+def readCache(filename, directory):
+    """ Returns the cached AnnotationIndex of filename, or None if there is none or the annotation has changed. A
+    cache whose size and modification time differ is still used if the content hash is the same, and is written
+    again with the new key so later runs need not hash the annotation. """
+    cache = cacheFilename(filename, directory)
+    if not os.path.exists(cache):
+        return None
+
+    stale = False
+
+    try:
+        with np.load(cache) as data:
+            cachedKey = json.loads(str(data["key"]))
+            key = annotationKey(filename, cachedKey[4])
+
+            if cachedKey[:4] != key[:4]:
+                if cachedKey[0] != CACHE_VERSION or cachedKey[4] != fileHash(filename):
+                    return None
+                stale = True
+
+            table = {field: data[field].tolist() for field in CACHE_FIELDS}
+            index = {
+                (chromosome, strand): (data["starts_sorted"][a:b], data["ends_sorted"][a:b], data["features"][a:b])
+                for chromosome, strand, a, b in zip(
+                    data["chromosomes_index"].tolist(),
+                    data["strands_index"].tolist(),
+                    data["offsets"][:-1].tolist(),
+                    data["offsets"][1:].tolist()
+                )
+            }
+    except (OSError, ValueError, KeyError):
+        print("[Warning] Annotation cache %s is unreadable and will be rebuilt" % (cache,))
+        return None
+
+    annotation = AnnotationIndex(filename, table, index)
+
+    if stale:
+        try:
+            writeCache(annotation, directory, key[4])
+        except OSError as e:
+            print("[Warning] Could not update the annotation cache: %s" % (e,))
+
+    return annotation
+
+
+def writeCache(annotation, directory, contentHash=None):
+    """ Compiles an AnnotationIndex into its cache file, and a GFF annotation into its BED6 as well, atomically.
+    contentHash saves hashing the annotation again if it is already known. """
+    cache = cacheFilename(annotation.filename, directory)
+    partial = "%s.%i.part" % (cache, os.getpid())
+    keys = list(annotation.index.keys())
+
+    if contentHash is None:
+        contentHash = fileHash(annotation.filename)
+
+    cacheKey = annotationKey(annotation.filename, contentHash)
+    if annotation.format == "gff":
+        writeBed(annotation, directory, cacheKey)
+
+    arrays = {field: np.array(getattr(annotation, field)) for field in CACHE_FIELDS}
+    arrays["key"] = np.array(json.dumps(cacheKey))
+    arrays["chromosomes_index"] = np.array([key[0] for key in keys])
+    arrays["strands_index"] = np.array([key[1] for key in keys])
+    arrays["offsets"] = np.cumsum([0] + [len(annotation.index[key][0]) for key in keys], dtype=np.int64)
+
+    for i, name in enumerate(["starts_sorted", "ends_sorted", "features"]):
+        parts = [annotation.index[key][i] for key in keys]
+        arrays[name] = np.concatenate(parts) if len(parts) > 0 else np.zeros(0, np.int64)
+
+    with open(partial, "wb") as fh:
+        np.savez(fh, **arrays)
+    os.replace(partial, cache)
+
+
+def bedKey(filename, directory):
+    """ Returns the cache key in the header line of the BED6 of filename, or an empty list if there is none. """
+    try:
+        with open(bedFilename(filename, directory), "r") as fh:
+            return json.loads(fh.readline()[1:])
+    except (OSError, ValueError):
+        return []
+
+
+def writeBed(annotation, directory, key):
+    """ Writes the features of a GFF annotation as BED6, atomically and in the order of the annotation file. Starts
+    are converted to 0-based, the feature type takes the place of the score. The header line holds the cache key,
+    intersectBed skips it as a comment. """
+    bed = bedFilename(annotation.filename, directory)
+    partial = "%s.%i.part" % (bed, os.getpid())
+
+    with open(partial, "w") as fh:
+        fh.write("#" + json.dumps(key) + "\n")
+        for i in range(0, len(annotation)):
+            fh.write("%s\t%i\t%i\t%s\t%s\t%s\n" % (
+                annotation.chromosomes[i], annotation.starts[i] - 1, annotation.ends[i], annotation.names[i],
+                annotation.types[i], annotation.strands[i]))
+    os.replace(partial, bed)
+
+
+class AnnotationIndex:
+    """ Per-chromosome and strand index over the features of a GFF or BED annotation.
+
+    Feature coordinates are kept exactly as runIntersect writes them into the Intersect .tab file: GFF starts are
+    1-based, BED starts are 0-based, and the ends are taken as they are. Features are sorted by start within every
+    (chromosome, strand) pair.
+
+    table and index restore a compiled index from the cache instead of parsing the file. """
+    filename = None
+    format = None
+
+    def __init__(self, filename, table=None, index=None):
+        self.filename = filename
+        self.format = annotationType(filename)
+
+        # Feature table, in the order of the annotation file
+        self.names = []
+        self.types = []
+        self.chromosomes = []
+        self.strands = []
+        self.starts = []
+        self.ends = []
+
+        # (chromosome, strand) -> (sorted starts, ends, feature indices)
+        self.index = {}
+
+        if table is not None:
+            for field in CACHE_FIELDS:
+                setattr(self, field, table[field])
+            self.index = index
+        else:
+            self.parse()
+            self.build()
+
+    def __len__(self):
+        return len(self.names)
+
+    def parse(self):
+        """ Reads the features. Like the awk script of runIntersect, columns are split on any whitespace. """
+        with open(self.filename, "r") as fh:
+            for line in fh:
+                if line.startswith("##FASTA"):
+                    break
+                if line.startswith("#") or line.startswith("track") or line.startswith("browser"):
+                    continue
+
+                line = line.split()
+
+                if self.format == "gff":
+                    if len(line) < 9:
+                        continue
+                    name = line[8].split(";")[0].replace("ID=", "", 1)
+                    featureType, start, end, strand = line[2], line[3], line[4], line[6]
+                else:
+                    if len(line) < 6:
+                        continue
+                    name = line[3]
+                    featureType, start, end, strand = "NA", line[1], line[2], line[5]
+
+                # intersectBed -s only reports features with a known strand
+                if strand not in ("+", "-"):
+                    continue
+
+                self.names.append(name)
+                self.types.append(featureType)
+                self.chromosomes.append(line[0])
+                self.strands.append(strand)
+                self.starts.append(int(start))
+                self.ends.append(int(end))
+
+    def build(self):
+        """ Sorts the features of every (chromosome, strand) pair by their start. """
+        groups = {}
+        for i in range(0, len(self.names)):
+            groups.setdefault((self.chromosomes[i], self.strands[i]), []).append(i)
+
+        starts = np.array(self.starts, np.int64)
+        ends = np.array(self.ends, np.int64)
+
+        for key in groups:
+            features = np.array(groups[key], np.int64)
+            features = features[np.argsort(starts[features], kind="mergesort")]
+            self.index[key] = (starts[features], ends[features], features)
+
+    def geneIndex(self, feature):
+        """ Returns the name_start_end key runModCount uses for a feature. """
+        return "%s_%i_%i" % (self.names[feature], self.starts[feature], self.ends[feature])
+
+    def assign(self, chromosome, strand, readStarts, readEnds):
+        """ Assigns the 5' stop of reads to the features that contain them.
+
+        readStarts (0-based) and readEnds are the aligned spans of reads on the given chromosome and strand. A read
+        counts for a feature if it lies inside of it, using the same rules as runModCount. Yields (feature,
+        positions) for every feature with at least one read, positions being indices into its count array. """
+        if (chromosome, strand) not in self.index:
+            return
+
+        starts, ends, features = self.index[(chromosome, strand)]
+
+        order = np.argsort(readStarts, kind="mergesort")
+        readStarts = readStarts[order]
+        readEnds = readEnds[order]
+
+        # Reads starting after the feature start and before its end are candidates
+        lower = np.searchsorted(readStarts, starts, "right")
+        upper = np.searchsorted(readStarts, ends, "left")
+
+        for i in np.flatnonzero(upper > lower):
+            candidateStarts = readStarts[lower[i]:upper[i]]
+            candidateEnds = readEnds[lower[i]:upper[i]]
+            inside = candidateEnds < ends[i]
+
+            if not inside.any():
+                continue
+
+            if strand == "+":
+                if self.format == "gff":
+                    positions = candidateStarts[inside] - starts[i]
+                else:
+                    positions = candidateStarts[inside] - starts[i] - 1
+            else:
+                positions = ends[i] - candidateEnds[inside] - 1
+
+            yield features[i], positions
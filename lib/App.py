@@ -2,7 +2,7 @@
 import colorama
 from datetime import datetime
 
-from .Routines import list_routines, get_routine
+from .Routines import list_routines, get_routine, RoutineNotFoundError
 
 MESSAGE_PROGRAM = "Program:\tquralk-pipe (tool chain for mod seq)"
 MESSAGE_VERSION = "Version:\t0.2.0-dev"
@@ -53,7 +53,8 @@ class App:
         try:
             self.routine = get_routine(self.routineKey)
         except RoutineNotFoundError:
-            print("Could not fine routine {}, aborting.".format(self.routineKey))
+            print("Could not find routine {}, aborting. Use help to list the routines.".format(self.routineKey))
+            exit(1)
 
         self.routine.set_arguments(self.arguments)
         self.routine.set_app_name(self.appName)
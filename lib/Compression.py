@@ -0,0 +1,99 @@
+import collections
+import concurrent.futures
+import os
+import shutil
+import threading
+import zlib
+
+# Size of the blocks that are compressed independently
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def compressBlock(block, level):
+    """ Compresses a block into a complete gzip member. zlib releases the GIL while compressing. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+def freeSpace(directory):
+    """ Returns the free space of the filesystem holding directory, in bytes. """
+    return shutil.disk_usage(directory).free
+
+
+class Compressor:
+    """ gzip replacement that compresses files in-process.
+
+    Files are cut into blocks which are compressed in parallel on a thread pool; every block becomes its own gzip
+    member, so the result is a standard (multi-member) gzip file that gzip, zcat, cutadapt and bowtie can read. Like
+    gzip -f, the compressed file keeps the modification time of the original, which is deleted afterwards.
+
+    Files can be compressed right away with compress, or in the background with submit. Background jobs are collected
+    with wait. """
+    threads = 4
+    level = 6
+
+    def __init__(self, threads=4, level=6):
+        self.threads = max(1, threads)
+        self.level = level
+        self.blockPool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self.filePool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def compress(self, filename):
+        """ Compresses filename into filename.gz and removes filename. """
+        target = filename + ".gz"
+        partial = target + ".part"
+        blocks = collections.deque()
+
+        with open(filename, "rb") as fhIn, open(partial, "wb") as fhOut:
+            while True:
+                block = fhIn.read(BLOCK_SIZE)
+                if block:
+                    blocks.append(self.blockPool.submit(compressBlock, block, self.level))
+
+                # Keep a bounded number of blocks in flight and write them in order
+                while blocks and (len(blocks) > 2 * self.threads or not block):
+                    fhOut.write(blocks.popleft().result())
+
+                if not block:
+                    break
+
+            if fhOut.tell() == 0:
+                # An empty file still needs a valid gzip member
+                fhOut.write(compressBlock(b"", self.level))
+
+        stat = os.stat(filename)
+        os.utime(partial, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(partial, target)
+        os.remove(filename)
+
+        return target
+
+    def submit(self, filename):
+        """ Compresses filename in the background. """
+        future = self.filePool.submit(self.compress, filename)
+
+        with self.lock:
+            self.pending.append((filename, future))
+
+        return future
+
+    def wait(self):
+        """ Waits for all background jobs. Returns a list of (filename, exception) for the failed ones. """
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+
+        failed = []
+        for filename, future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                failed.append((filename, e))
+
+        return failed
+
+    def shutdown(self):
+        self.filePool.shutdown()
+        self.blockPool.shutdown()
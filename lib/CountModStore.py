@@ -0,0 +1,302 @@
+""" Storage formats for CountMod files.
+
+Text (.tab): a description line starting with > followed by a line with the space separated counts of every
+position, for every gene. writeText also leaves an index (.tab.idx) next to the file, a JSON document with the size
+and modification time of the file and the description and count line offset of every gene, so that readers do not
+need to scan the count lines to find the genes.
+
+Binary (.cmb): a fixed header, followed by the counts of all genes as contiguous little-endian int32 arrays and a
+JSON gene index at the end of the file:
+
+    offset  size  content
+    0       4     magic b"QCMB"
+    4       4     format version, uint32
+    8       8     byte offset of the gene index, uint64
+    16      8     byte length of the gene index, uint64
+    24      8     reserved
+    32      ...   count arrays
+
+The gene index is a list of {"description": [...], "offset": ..., "length": ...} entries, description holding the
+same nine fields as the description line of the text format. The file can be memory-mapped and every gene's counts
+read as a zero-copy view.
+"""
+
+import csv
+import json
+import os
+import struct
+
+import numpy as np
+
+BINARY_MAGIC = b"QCMB"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sIQQ8x")
+BINARY_DTYPE = np.dtype("<i4")
+
+TEXT_EXTENSION = ".tab"
+TEXT_INDEX_EXTENSION = ".idx"
+
+# Characters a count line may consist of
+COUNT_CHARACTERS = b"0123456789- \r\n"
+BINARY_EXTENSION = ".cmb"
+
+
+def isBinary(filename):
+    """ Returns True if filename is a binary CountMod file, judging by its extension. """
+    return filename.endswith(BINARY_EXTENSION)
+
+
+def geneIndex(description):
+    """ Returns the name_start_end key of a gene description. """
+    return description[0] + "_" + str(int(description[4])) + "_" + str(int(description[5]))
+
+
+def writeText(filename, genes):
+    """ Writes genes (gene_index -> gene) to a text CountMod file and its index. """
+    index = []
+
+    with open(filename, "w") as fh:
+        writer = csv.writer(fh, delimiter=" ")
+        for gene_index in genes:
+            description = genes[gene_index].description
+            writer.writerow([">"] + description)
+            index.append({"description": [str(x) for x in description], "offset": fh.tell()})
+            writer.writerow(genes[gene_index].countArray)
+
+    writeTextIndex(filename, index)
+
+
+def writeTextIndex(filename, index):
+    """ Writes the index of a text CountMod file, atomically. It is only valid as long as the file is unchanged. """
+    stat = os.stat(filename)
+    indexFile = filename + TEXT_INDEX_EXTENSION
+
+    with open(indexFile + ".tmp", "w") as fh:
+        json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "genes": index}, fh)
+    os.replace(indexFile + ".tmp", indexFile)
+
+
+def readTextIndex(filename):
+    """ Returns the gene entries of the index of a text CountMod file, or None if there is none or the file has
+    changed since it has been written. """
+    try:
+        with open(filename + TEXT_INDEX_EXTENSION, "r") as fh:
+            index = json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+    stat = os.stat(filename)
+    if index.get("size") != stat.st_size or index.get("mtime_ns") != stat.st_mtime_ns:
+        return None
+
+    return index.get("genes")
+
+
+def writeBinary(filename, genes):
+    """ Writes genes (gene_index -> gene) to a binary CountMod file. """
+    index = []
+
+    with open(filename, "wb") as fh:
+        fh.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, 0))
+
+        for gene_index in genes:
+            counts = np.asarray(genes[gene_index].countArray, BINARY_DTYPE)
+            index.append({
+                "description": [str(x) for x in genes[gene_index].description],
+                "offset": fh.tell(),
+                "length": len(counts),
+            })
+            fh.write(counts.tobytes())
+
+        indexOffset = fh.tell()
+        indexData = json.dumps(index).encode("utf-8")
+        fh.write(indexData)
+
+        fh.seek(0)
+        fh.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, indexOffset, len(indexData)))
+
+
+def write(filename, genes):
+    """ Writes genes in the format given by the extension of filename. """
+    if isBinary(filename):
+        writeBinary(filename, genes)
+    else:
+        writeText(filename, genes)
+
+
+def parseCounts(line, description, filename):
+    """ Parses a count line into an int64 array. Raises if it does not hold one integer for every position of the
+    gene, eg. because the file has been truncated. """
+    if isinstance(line, str):
+        line = line.encode("utf-8")
+
+    # np.fromstring quietly stops at the first value that is not an integer and reads an empty line as [0]
+    if line.translate(None, COUNT_CHARACTERS):
+        raise Exception("%s: the counts of gene %s are not all integers" % (filename, geneIndex(description)))
+
+    counts = np.fromstring(line, np.int64, sep=" ") if line.strip() else np.zeros(0, np.int64)
+
+    if len(counts) != int(description[6]):
+        raise Exception("%s: expected %s counts for gene %s, found %i" % (
+            filename, description[6], geneIndex(description), len(counts)))
+
+    return counts
+
+
+def readText(filename):
+    """ Yields (description, counts) for every gene of a text CountMod file. description is a list of the nine
+    description fields as strings, counts the unparsed count line. """
+    with open(filename, "r") as fh:
+        for line in fh:
+            # Skip non-description lines
+            if not line.startswith(">"):
+                continue
+
+            yield line.split()[1:10], next(fh)
+
+
+def openReader(filename):
+    """ Opens a CountMod file for random access by gene, picking the reader by the file extension. """
+    if isBinary(filename):
+        return BinaryReader(filename)
+    else:
+        return TextReader(filename)
+
+
+class TextReader:
+    """ Random access reader of a text CountMod file.
+
+    Opening the file only reads the description and the start of the count line of every gene, from the index of
+    the file if it is up to date. Otherwise the description lines are read from the file itself and the count lines
+    are skipped undecoded. Count lines are parsed on request. """
+    filename = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.genes = {}
+        self.offsets = {}
+
+        index = readTextIndex(filename)
+        if index is not None:
+            for entry in index:
+                key = geneIndex(entry["description"])
+                self.genes[key] = entry["description"]
+                self.offsets[key] = entry["offset"]
+            return
+
+        with open(filename, "rb") as fh:
+            for line in iter(fh.readline, b""):
+                if line.startswith(b">"):
+                    description = line.decode("utf-8").split()[1:10]
+                    key = geneIndex(description)
+                    self.genes[key] = description
+                    self.offsets[key] = fh.tell()
+
+                    # Skip the count line
+                    fh.readline()
+
+    def keys(self):
+        """ Returns the gene_index keys in file order. """
+        return self.genes.keys()
+
+    def description(self, key):
+        return self.genes[key]
+
+    def counts(self, key):
+        """ Parses the count line of a gene into an int64 array. """
+        with open(self.filename, "rb") as fh:
+            fh.seek(self.offsets[key])
+            return parseCounts(fh.readline(), self.genes[key], self.filename)
+
+    def read(self, keys):
+        """ Yields (key, description, counts) for every gene in keys, reading the file front to back. """
+        with open(self.filename, "rb") as fh:
+            for key in sorted(keys, key=lambda key: self.offsets[key]):
+                fh.seek(self.offsets[key])
+                yield key, self.genes[key], parseCounts(fh.readline(), self.genes[key], self.filename)
+
+
+class BinaryReader:
+    """ Memory-mapped reader of a binary CountMod file. """
+    filename = None
+    index = None
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, "rb") as fh:
+            magic, version, indexOffset, indexLength = BINARY_HEADER.unpack(fh.read(BINARY_HEADER.size))
+
+            if magic != BINARY_MAGIC:
+                raise Exception("%s is not a binary CountMod file" % filename)
+            if version != BINARY_VERSION:
+                raise Exception("%s has unsupported CountMod format version %i" % (filename, version))
+
+            fh.seek(indexOffset)
+            self.index = json.loads(fh.read(indexLength).decode("utf-8"))
+
+        self.data = np.memmap(filename, np.uint8, "r")
+        self.genes = {geneIndex(entry["description"]): entry for entry in self.index}
+
+    def __getstate__(self):
+        # A reader sent to another process maps the file again instead of copying it
+        state = self.__dict__.copy()
+        del state["data"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = np.memmap(self.filename, np.uint8, "r")
+
+    def __iter__(self):
+        """ Yields (description, counts) for every gene, counts being a read-only view into the file. """
+        for entry in self.index:
+            yield entry["description"], self.view(entry)
+
+    def keys(self):
+        """ Returns the gene_index keys in file order. """
+        return self.genes.keys()
+
+    def description(self, key):
+        return self.genes[key]["description"]
+
+    def counts(self, key):
+        """ Returns the counts of a gene as zero-copy int32 view. """
+        return self.view(self.genes[key])
+
+    def read(self, keys):
+        """ Yields (key, description, counts) for every gene in keys. """
+        for key in keys:
+            yield key, self.genes[key]["description"], self.view(self.genes[key])
+
+    def view(self, entry):
+        """ Returns the counts of an index entry as zero-copy int32 view. """
+        if entry["length"] == 0:
+            return np.zeros(0, BINARY_DTYPE)
+
+        start = entry["offset"]
+        return np.asarray(self.data[start:start + entry["length"] * BINARY_DTYPE.itemsize]).view(BINARY_DTYPE)
+
+
+class StoredGene:
+    """ Gene as read back from a CountMod file, carrying only what the writers need. """
+
+    def __init__(self, description, countArray):
+        self.description = description
+        self.countArray = countArray
+
+
+def convert(source, target):
+    """ Converts a CountMod file into the format given by the extension of target. Returns the number of genes. """
+    genes = {}
+
+    if isBinary(source):
+        for description, counts in BinaryReader(source):
+            genes[geneIndex(description)] = StoredGene(description, counts.tolist())
+    else:
+        for description, counts in readText(source):
+            genes[geneIndex(description)] = StoredGene(description, parseCounts(counts, description, source))
+
+    write(target, genes)
+
+    return len(genes)
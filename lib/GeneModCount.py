@@ -1,14 +1,27 @@
 import numpy as np
 
-class GeneModCount2:
-    name = None
-    chrms = None
-    strain = None
-    featureType = None
+# Counts are stored as in binary CountMod files, which also lets genes keep zero-copy views into them
+COUNT_DTYPE = np.int32
+
 
-    Start = 0
-    End = 0
-    length = 1
+class GeneModCount2:
+    """ Modification counts of a gene.
+
+    Counts are held in a typed NumPy array, the test array is only allocated once it is used and the description is
+    built from the current fields when it is asked for. """
+    __slots__ = (
+        "name",
+        "chrms",
+        "strain",
+        "featureType",
+        "Start",
+        "End",
+        "length",
+        "count",
+        "countPerNt",
+        "_countArray",
+        "_testArray",
+    )
 
     def __init__(self, gene_name, chromosome, strain, feature_type, pos_start, pos_end):
         self.name = gene_name
@@ -20,27 +33,36 @@ class GeneModCount2:
         self.End = int(pos_end)
         self.length = self.End - self.Start + 1
 
-        #self.countArray = np.zeros(self.length, np.int32)
-        self.countArray = [0 for i in range(self.length)]
-        self.testArray = ["NA" for i in range(0, self.length)]
+        # Allocated on first use
+        self._countArray = None
+        self._testArray = None
 
-        self.prepare_description()
+        self.count = 0
+        self.countPerNt = 0.0
 
-    def restore_from_storage(gene_name, chromosome, strain, feature_type, pos_start, pos_end, length, count, count_per_nt):
-        gene = GeneModCount2(gene_name, chromosome, strain, feature_type, pos_start, pos_end)
-        gene.length = int(length)
-        gene.count = int(count)
-        gene.countPerNt = float(count_per_nt)
+    @property
+    def countArray(self):
+        if self._countArray is None:
+            self._countArray = np.zeros(self.length, COUNT_DTYPE)
+        return self._countArray
 
-        return gene
+    @countArray.setter
+    def countArray(self, counts):
+        self._countArray = np.asarray(counts, COUNT_DTYPE)
 
-    def calculate_statistics(self):
-        self.count = sum(self.countArray)
-        self.countPerNt = self.count / self.length
+    @property
+    def testArray(self):
+        if self._testArray is None:
+            self._testArray = ["NA" for i in range(0, self.length)]
+        return self._testArray
 
-    def prepare_description(self):
-        self.calculate_statistics()
-        self.description = [
+    @testArray.setter
+    def testArray(self, testArray):
+        self._testArray = testArray
+
+    @property
+    def description(self):
+        return [
             self.name,
             self.chrms,
             self.strain,
@@ -52,9 +74,23 @@ class GeneModCount2:
             self.countPerNt
         ]
 
+    def restore_from_storage(gene_name, chromosome, strain, feature_type, pos_start, pos_end, length, count, count_per_nt):
+        gene = GeneModCount2(gene_name, chromosome, strain, feature_type, pos_start, pos_end)
+        gene.length = int(length)
+        gene.count = int(count)
+        gene.countPerNt = float(count_per_nt)
+
+        return gene
+
+    def calculate_statistics(self):
+        self.count = int(np.sum(self.countArray, dtype=np.int64))
+        self.countPerNt = self.count / self.length
+
+    def prepare_description(self):
+        self.calculate_statistics()
+
     def getDescription(self):
         self.calculate_statistics()
-        self.prepare_description()
         return self.description
 
 
@@ -0,0 +1,165 @@
+import json
+import os
+import socket
+import threading
+import time
+
+LEASE_EXTENSION = ".lease"
+DONE_EXTENSION = ".done"
+FAILED_EXTENSION = ".failed"
+
+
+def ownerName():
+    """ Identifies this process among all hosts sharing the lease directory. """
+    return "%s:%i" % (socket.gethostname(), os.getpid())
+
+
+class LeaseDirectory:
+    """ Hands out work items to several hosts through files in a shared directory.
+
+    A host owns an item as long as it holds <item>.lease, which is created atomically with O_EXCL. The modification
+    time of held leases is refreshed by a heartbeat thread; a lease that has not been refreshed for timeout seconds
+    belongs to a crashed host and is reclaimed. Finished items are marked with <item>.done or <item>.failed, holding
+    a stamp (eg. the modification time of the input) so that markers of changed inputs are ignored. """
+    directory = None
+    timeout = 300
+    owner = None
+
+    def __init__(self, directory, timeout=300):
+        self.directory = directory
+        self.timeout = timeout
+        self.owner = ownerName()
+        self.held = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, item, extension):
+        return os.path.join(self.directory, item + extension)
+
+    def status(self, item, stamp):
+        """ Returns "done" or "failed" if the item has been finished with the same stamp, "leased" if a host holds a
+        live lease on it and None if it is free to claim. """
+        for status, extension in (("done", DONE_EXTENSION), ("failed", FAILED_EXTENSION)):
+            try:
+                with open(self.path(item, extension)) as fh:
+                    if json.load(fh).get("stamp") == stamp:
+                        return status
+            except (FileNotFoundError, ValueError):
+                pass
+
+        try:
+            if time.time() - os.stat(self.path(item, LEASE_EXTENSION)).st_mtime <= self.timeout:
+                return "leased"
+        except FileNotFoundError:
+            pass
+
+        return None
+
+    def holds(self, item):
+        """ Returns True if this process holds the lease on item. """
+        with self.lock:
+            return item in self.held
+
+    def claim(self, item, stamp):
+        """ Tries to take the lease on item. Returns True if this process holds it afterwards. """
+        if self.status(item, stamp) is not None:
+            return False
+
+        lease = self.path(item, LEASE_EXTENSION)
+
+        if os.path.exists(lease) and not self.reclaim(item):
+            return False
+
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            # Another host has been faster
+            return False
+
+        with os.fdopen(fd, "w") as fh:
+            json.dump({"owner": self.owner, "stamp": stamp, "claimed": time.time()}, fh)
+
+        # A marker may have been written between the check and the claim
+        if self.status(item, stamp) in ("done", "failed"):
+            os.remove(lease)
+            return False
+
+        with self.lock:
+            self.held[item] = lease
+            self.start_heartbeat()
+
+        return True
+
+    def reclaim(self, item):
+        """ Removes a stale lease. Only one host can move the lease away; if the moved lease turns out to be fresh,
+        because its owner has just renewed it or another host has just claimed it, it is put back. """
+        lease = self.path(item, LEASE_EXTENSION)
+        stale = "%s.stale-%s" % (lease, self.owner.replace(":", "-"))
+
+        try:
+            if time.time() - os.stat(lease).st_mtime <= self.timeout:
+                return False
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            # Already reclaimed by another host
+            return True
+
+        if time.time() - os.stat(stale).st_mtime <= self.timeout:
+            try:
+                os.link(stale, lease)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+
+        with open(stale) as fh:
+            try:
+                print("Reclaimed stale lease of %s from %s" % (item, json.load(fh).get("owner")))
+            except ValueError:
+                print("Reclaimed stale lease of %s" % (item,))
+
+        os.remove(stale)
+        return True
+
+    def release(self, item, stamp, success):
+        """ Marks item as done or failed and gives up its lease. """
+        marker = self.path(item, DONE_EXTENSION if success else FAILED_EXTENSION)
+        partial = "%s.%s" % (marker, self.owner.replace(":", "-"))
+
+        with open(partial, "w") as fh:
+            json.dump({"owner": self.owner, "stamp": stamp, "finished": time.time()}, fh)
+        os.replace(partial, marker)
+
+        with self.lock:
+            lease = self.held.pop(item, None)
+
+        if lease is not None:
+            try:
+                os.remove(lease)
+            except FileNotFoundError:
+                pass
+
+    def start_heartbeat(self):
+        """ Starts the thread renewing all held leases. Must be called with lock held. """
+        if self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self.run_heartbeat)
+            self.heartbeat.daemon = True
+            self.heartbeat.start()
+
+    def run_heartbeat(self):
+        while not self.stopped.wait(self.timeout / 5):
+            with self.lock:
+                leases = list(self.held.items())
+
+            for item, lease in leases:
+                try:
+                    os.utime(lease)
+                except FileNotFoundError:
+                    print("[Warning] The lease of %s has been lost, another host may run it as well" % (item,))
+
+    def close(self):
+        self.stopped.set()
@@ -0,0 +1,167 @@
+import contextlib
+import csv
+import datetime
+import json
+import os
+import resource
+import threading
+import time
+
+from lib.Pipeline import existingFile
+
+FIELDS = [
+    "job",
+    "stage",
+    "status",
+    "start",
+    "wallSeconds",
+    "cpuSeconds",
+    "childCpuSeconds",
+    "peakRssKB",
+    "childPeakRssKB",
+    "inputBytes",
+    "outputBytes",
+    "concurrentJobs",
+]
+
+
+def fileBytes(filenames):
+    """ Returns the summed size of the files that exist, taking gzipped versions into account. """
+    total = 0
+
+    for filename in filenames:
+        existing = existingFile(filename)
+        if existing is not None:
+            total += os.path.getsize(existing)
+
+    return total
+
+
+class Metrics:
+    """ Collects performance metrics of the jobs of a run, eg. the stages of every sample.
+
+    For every job, the wall time, the CPU time of the calling thread, the CPU time of child processes that ended
+    during the job, the peak resident set size of this process and of its largest child (both high-water marks, in KB
+    on Linux) and the size of its input and output files are recorded. Child CPU time is counted for the whole
+    process, so it can only be attributed to a single job if concurrentJobs is 1. Jobs may be measured from
+    several threads at the same time. """
+
+    def __init__(self):
+        self.records = []
+        self.running = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, job, stage, inputs=(), outputs=()):
+        """ Measures the code run inside the with block as stage of job. Output sizes are taken at the end. """
+        record = {field: None for field in FIELDS}
+        record.update(job=job, stage=stage, status="done", start=datetime.datetime.now().isoformat())
+        record["inputBytes"] = fileBytes(inputs)
+
+        with self.lock:
+            self.running.append(record)
+            for other in self.running:
+                other["concurrentJobs"] = max(other["concurrentJobs"] or 0, len(self.running))
+
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wallStart = time.perf_counter()
+        cpuStart = time.thread_time()
+
+        try:
+            yield record
+        except BaseException:
+            record["status"] = "failed"
+            raise
+        finally:
+            record["wallSeconds"] = time.perf_counter() - wallStart
+            record["cpuSeconds"] = time.thread_time() - cpuStart
+
+            childrenEnd = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record["childCpuSeconds"] = (childrenEnd.ru_utime + childrenEnd.ru_stime) - \
+                                        (children.ru_utime + children.ru_stime)
+            record["childPeakRssKB"] = childrenEnd.ru_maxrss
+            record["peakRssKB"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            record["outputBytes"] = fileBytes(outputs)
+
+            with self.lock:
+                self.running.remove(record)
+                self.records.append(record)
+
+    def skip(self, job, stage):
+        """ Records a job that was not run, eg. because its outputs were up to date. """
+        record = {field: None for field in FIELDS}
+        record.update(job=job, stage=stage, status="skipped")
+
+        with self.lock:
+            self.records.append(record)
+
+    def write(self, directory, name):
+        """ Writes all records to metrics_<name>_<time>.json and .tsv in directory. Returns both filenames. """
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        basename = os.path.join(directory, "metrics_%s_%s" % (name, timestamp))
+
+        with self.lock:
+            records = list(self.records)
+
+        with open(basename + ".json", "w") as fh:
+            json.dump(records, fh, indent=4)
+
+        with open(basename + ".tsv", "w") as fh:
+            writer = csv.DictWriter(fh, FIELDS, delimiter="\t", lineterminator="\n", restval="")
+            writer.writeheader()
+            writer.writerows(records)
+
+        return basename + ".json", basename + ".tsv"
+
+    def summary(self):
+        """ Sums the jobs that have been run up per stage, in the order the stages have first been seen. """
+        stages = {}
+
+        with self.lock:
+            records = [record for record in self.records if record["status"] != "skipped"]
+
+        for record in records:
+            if record["stage"] not in stages:
+                stages[record["stage"]] = {
+                    "stage": record["stage"], "jobs": 0, "failed": 0, "wallSeconds": 0.0, "maxWallSeconds": 0.0,
+                    "cpuSeconds": 0.0, "childCpuSeconds": 0.0, "peakRssKB": 0, "inputBytes": 0, "outputBytes": 0,
+                }
+
+            total = stages[record["stage"]]
+            total["jobs"] += 1
+            total["failed"] += 1 if record["status"] == "failed" else 0
+            total["wallSeconds"] += record["wallSeconds"]
+            total["maxWallSeconds"] = max(total["maxWallSeconds"], record["wallSeconds"])
+            total["cpuSeconds"] += record["cpuSeconds"]
+            total["childCpuSeconds"] += record["childCpuSeconds"]
+            total["peakRssKB"] = max(total["peakRssKB"], record["peakRssKB"], record["childPeakRssKB"])
+            total["inputBytes"] += record["inputBytes"]
+            total["outputBytes"] += record["outputBytes"]
+
+        return list(stages.values())
+
+    def printSummary(self):
+        """ Prints the per-stage summary as a table. """
+        rows = self.summary()
+        if len(rows) == 0:
+            return
+
+        line = "{:<16} {:>5} {:>6} {:>11} {:>11} {:>10} {:>10} {:>10} {:>10} {:>10}"
+
+        print("\nPerformance summary:")
+        print(line.format("stage", "jobs", "failed", "wall [s]", "max wall", "cpu [s]", "child cpu", "peak [MB]",
+                          "in [MB]", "out [MB]"))
+
+        for row in rows:
+            print(line.format(
+                row["stage"],
+                row["jobs"],
+                row["failed"],
+                "%.1f" % row["wallSeconds"],
+                "%.1f" % row["maxWallSeconds"],
+                "%.1f" % row["cpuSeconds"],
+                "%.1f" % row["childCpuSeconds"],
+                "%.0f" % (row["peakRssKB"] / 1024),
+                "%.1f" % (row["inputBytes"] / 1024 ** 2),
+                "%.1f" % (row["outputBytes"] / 1024 ** 2),
+            ))
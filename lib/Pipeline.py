@@ -0,0 +1,129 @@
+import json
+import os
+
+
+def existingFile(filename):
+    """ Returns filename, or its gzipped version if only that one exists. Returns None if neither exists. """
+    if os.path.exists(filename):
+        return filename
+    elif os.path.exists(filename + ".gz"):
+        return filename + ".gz"
+    else:
+        return None
+
+
+class Stage:
+    """ A single step of the sample pipeline.
+
+    A stage declares the files it reads and writes and the configuration keys its result depends on. Outputs listed
+    as intermediates may be deleted by a later stage and are not required to exist for the stage to be up to date.
+    resource names the kind of work a stage mostly does (align, io or python) and is used to limit how many stages of
+    a kind run at the same time. """
+    name = None
+    function = None
+    error = None
+    resource = "python"
+
+    def __init__(self, name, function, error, inputs=(), outputs=(), config=(), intermediates=(), resource="python"):
+        self.name = name
+        self.function = function
+        self.error = error
+        self.resource = resource
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.config = list(config)
+        self.intermediates = list(intermediates)
+
+    def fingerprint(self, settings):
+        """ Returns the configuration values this stage depends on. """
+        return {key: str(settings.get(key)) for key in self.config}
+
+    def isUpToDate(self, record, settings):
+        """ Checks whether the outputs of a former run recorded as record can be reused. They can if the
+        configuration has not changed, all outputs exist and none is older than any of the inputs. """
+        if record is None or record != self.fingerprint(settings):
+            return False
+
+        outputs = []
+        for filename in self.outputs:
+            existing = existingFile(filename)
+            if existing is None:
+                if filename in self.intermediates:
+                    continue
+                return False
+            outputs.append(existing)
+
+        inputs = [existingFile(filename) for filename in self.inputs]
+        inputs = [filename for filename in inputs if filename is not None]
+
+        if len(inputs) == 0 or len(outputs) == 0:
+            return True
+
+        return max(os.path.getmtime(x) for x in inputs) <= min(os.path.getmtime(x) for x in outputs)
+
+
+class PipelineState:
+    """ Stores which stages of a sample have been completed, and with which configuration. """
+    filename = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.stages = {}
+
+        if os.path.exists(filename):
+            with open(filename, "r") as fh:
+                self.stages = json.load(fh)
+
+    def get(self, stageName):
+        return self.stages.get(stageName)
+
+    def record(self, stage, settings):
+        """ Marks stage as completed with the current configuration. """
+        self.stages[stage.name] = stage.fingerprint(settings)
+        self.write()
+
+    def invalidate(self, stages):
+        """ Forgets about stages, eg. before they are run again. """
+        for stage in stages:
+            self.stages.pop(stage.name, None)
+        self.write()
+
+    def write(self):
+        with open(self.filename + ".tmp", "w") as fh:
+            json.dump(self.stages, fh, indent=4, sort_keys=True)
+        os.replace(self.filename + ".tmp", self.filename)
+
+
+def firstStageToRun(stages, state, settings, forceFrom=None):
+    """ Returns the index of the first stage that has to run; every stage after it has to run as well.
+
+    A stage runs if it is forced, if it is not up to date, or if a later stage needs an input that an earlier stage
+    produced and that does not exist anymore. """
+    names = [stage.name for stage in stages]
+    start = len(stages)
+
+    if forceFrom is not None:
+        start = names.index(forceFrom)
+
+    for i in range(0, start):
+        if not stages[i].isUpToDate(state.get(stages[i].name), settings):
+            start = i
+            break
+
+    # Go back as long as running stages miss inputs that were created by skipped stages
+    changed = True
+    while changed:
+        changed = False
+
+        for stage in stages[start:]:
+            for filename in stage.inputs:
+                if existingFile(filename) is not None:
+                    continue
+
+                for i in range(0, start):
+                    if filename in stages[i].outputs:
+                        start = i
+                        changed = True
+                        break
+
+    return start
@@ -1,18 +1,45 @@
 import colorama
+import importlib
 from collections import OrderedDict
 
 from .routines.BaseRoutine import BaseRoutine
-from .routines.ModRoutine import ModRoutine
-from .routines.StatRoutine import StatRoutine
-from .routines.HistoRoutine import HistoRoutine
+
+
+class RoutineEntry:
+    """ A registered routine. Its module is only imported once the routine is selected, as some routines pull in
+    matplotlib or scipy. """
+    name = None
+    module = None
+    className = None
+    help = None
+
+    def __init__(self, name, module, className, help):
+        self.name = name
+        self.module = module
+        self.className = className
+        self.help = help
+        self.routine = None
+
+    def load(self):
+        if self.routine is None:
+            module = importlib.import_module(self.module, __package__)
+            self.routine = getattr(module, self.className)()
+
+        return self.routine
+
 
 def get_routine(key):
     if key in routines:
-        return routines[key]
+        return routines[key].load()
     else:
         raise RoutineNotFoundError("Routine does not exist")
 
 
+def get_routine_help(key):
+    """ Returns the one-line help of a routine without importing it. """
+    return routines[key].help
+
+
 def list_routines():
     for key in routines:
         yield key
@@ -33,7 +60,7 @@ class HelpRoutine(BaseRoutine):
             print(self.MESSAGE_COMMAND_LIST)
 
             for routine in list_routines():
-                print(" • {}\t\t{}".format(routine, get_routine(routine).get_cli_help()))
+                print(" • {}\t\t{}".format(routine, get_routine_help(routine)))
         else:
             # More specific help
             if self.arguments[0] in list_routines():
@@ -52,12 +79,29 @@ If you just want to now how the help works...
 {}Congratulations, you just used it!{}""".format(colorama.Fore.GREEN, colorama.Fore.RESET)
 
 
-# Register routines here
+# Register routines here: name, module, class and the one-line help shown by help
 routines = {
-    "help": HelpRoutine(),
-    "mod": ModRoutine(),
-    "stat": StatRoutine(),
-    "histo": HistoRoutine(),
+    "help": RoutineEntry("help", ".Routines", "HelpRoutine", HelpRoutine.MESSAGE_CLI_HELP),
+    "mod": RoutineEntry(
+        "mod", ".routines.ModRoutine", "ModRoutine",
+        "Aligns fastq data to a genom and counts modifications"
+    ),
+    "stat": RoutineEntry(
+        "stat", ".routines.StatRoutine", "StatRoutine",
+        "Runs statistical tests over the data created with mod and saves only significant gene positions"
+    ),
+    "stat-merge": RoutineEntry(
+        "stat-merge", ".routines.StatMergeRoutine", "StatMergeRoutine",
+        "Merges the partial files of a sharded stat run into a single output file"
+    ),
+    "histo": RoutineEntry(
+        "histo", ".routines.HistoRoutine", "HistoRoutine",
+        "Creates histogram for every single gene"
+    ),
+    "convert": RoutineEntry(
+        "convert", ".routines.ConvertRoutine", "ConvertRoutine",
+        "Converts CountMod files between the text (.tab) and binary (.cmb) format"
+    ),
 }
 
-routines = OrderedDict(sorted(routines.items(), key=lambda t: t[0]))
\ No newline at end of file
+routines = OrderedDict(sorted(routines.items(), key=lambda t: t[0]))
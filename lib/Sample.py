@@ -1,45 +1,285 @@
-import csv
+import array
+import gzip
+import io
 import os
+import re
 import subprocess
+import threading
 import traceback
 
+import numpy as np
+
+from lib import CountModStore
+from lib.Annotation import annotationType, intersectAnnotation, loadAnnotation
+from lib.Compression import freeSpace
+from lib.Pipeline import PipelineState, Stage, firstStageToRun
+
 SAMTOOLS_SORT_MEMORY = "500M"
 
+# Number of alignments the native counting engine assigns to genes at once
+NATIVE_COUNT_CHUNK = 1000000
+
+# Number of bytes of an Intersect .tab file the bulk parser reads at once
+BULK_COUNT_CHUNK = 64 * 1024 * 1024
+
+CIGAR_REFERENCE_OPS = re.compile(r"(\d+)[MDN=X]")
+
+# Number of bytes the tee of the streamed trimming copies at once
+TEE_BLOCK_SIZE = 1024 * 1024
+
+
+def cigarLength(cigar):
+    """ Returns the number of reference bases covered by a CIGAR string. """
+    if cigar[:-1].isdigit() and cigar[-1] == "M":
+        return int(cigar[:-1])
+    return sum(int(x) for x in CIGAR_REFERENCE_OPS.findall(cigar))
+
+
+def intColumn(tokens):
+    """ Converts a list of integer strings into an int64 array. Raises ValueError if any of them is not an integer. """
+    return np.array(tokens, np.int64)
+
+
+def strandColumn(tokens):
+    """ Converts a list of strand strings into a bytes array. """
+    joined = "".join(tokens).encode()
+    if len(joined) == len(tokens):
+        return np.frombuffer(joined, "S1")
+    return np.array(tokens, "S")
+
+
+def closePipe(pipe):
+    """ Closes one end of a pipe. A reader that has already died is reported by its exit code instead. """
+    try:
+        pipe.close()
+    except BrokenPipeError:
+        pass
+
+
+def checkProcesses(processes):
+    """ Waits for all (process, cli) pairs of a pipe, given in pipe order, and raises if any of them failed. When a
+    process dies, the ones before it fail on the broken pipe, so the last failed process is reported. """
+    failed = None
+
+    for process, cli in processes:
+        status = process.wait()
+        if status != 0:
+            failed = subprocess.CalledProcessError(status, cli)
+
+    if failed is not None:
+        raise failed
+
+
+class Tee(threading.Thread):
+    """ Copies a stream into a number of pipes and, compressed, into an archive file. The source and the targets are
+    closed at the end of the stream; errors are kept in error. """
+    source = None
+    targets = None
+    archive = None
+    error = None
+
+    def __init__(self, source, targets, archive):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.source = source
+        self.targets = targets
+        self.archive = archive
+        self.error = None
+
+    def run(self):
+        try:
+            with self.source as fhIn, gzip.open(self.archive, "wb", compresslevel=6) as fhArchive:
+                while True:
+                    block = fhIn.read(TEE_BLOCK_SIZE)
+                    if not block:
+                        break
+
+                    fhArchive.write(block)
+                    for target in self.targets:
+                        target.write(block)
+        except Exception as e:
+            self.error = e
+        finally:
+            for target in self.targets:
+                closePipe(target)
+
 
 class Sample():
     sampleName = None
     settings = None
+    forceFrom = None
+    compressor = None
+    metrics = None
 
-    def __init__(self, sampleName, settings):
+    def __init__(self, sampleName, settings, forceFrom=None, compressor=None, metrics=None):
         self.sampleName = sampleName
         self.settings = settings
+        self.forceFrom = forceFrom
+        self.compressor = compressor
+        self.metrics = metrics
 
     def run(self):
-        """ The essential pipeline is assembled here and called in order they are put into jobs.
-        Beware that these processes depend on each other: Everyone expects the output file of the former one as input
+        """ Runs all stages of the sample pipeline in order. Stages whose outputs are up to date with their inputs and
+        configuration are skipped, unless forced by forceFrom. Returns True if the sample has been completed. """
+        stages, state = self.prepareStages()
 
-        (I may need to do this differently, but how often does this sequence get modified?)
-        """
-        jobs = [
-            ["cutadapters", self.runCutAdapters, "[Error] Failed to run cutadapt for %s"],
-            ["bowtieAlign", self.runBowtieAlign, "[Error] Failed ro run bowtie for %s"],
-            ["fivePrimeFix", self.runFivePrimeFix, "[Error] Failed to run fivePrimeFix for %s"],
-            ["samToBam", self.runSamToBam, "[Error] Failed to run samtools for %s"],
-            ["sortBam", self.runSortBam, "[Error] Failed to run samtools for %s"],
-            ["intersect", self.runIntersect, "[Error] Failed to run BEDTools for %s"],
-            ["modcount", self.runModCount, "[Error] Failed to run modCount for %s"]
-        ]
-
-        for job in jobs:
-            try:
-                job[1]()
-            except Exception as e:
-                print(e)
-                traceback.print_tb(e.__traceback__)
-                print(job[2] % (self.sampleName,))
-                return
+        for stage in stages:
+            if not self.runStage(stage, state):
+                return False
 
         print("Completed sample %s" % (self.sampleName,))
+        return True
+
+    def prepareStages(self):
+        """ Returns the stages that need to run, in order, and the pipeline state to record them in. """
+        stages = self.getStages()
+        state = PipelineState(self.getFileName("PipelineState", ".json"))
+        start = firstStageToRun(stages, state, self.settings, self.forceFrom)
+
+        for stage in stages[:start]:
+            print("Skipping up-to-date stage %s for sample %s" % (stage.name, self.sampleName))
+            if self.metrics is not None:
+                self.metrics.skip(self.sampleName, stage.name)
+
+        state.invalidate(stages[start:])
+
+        return stages[start:], state
+
+    def runStage(self, stage, state):
+        """ Runs a single stage and records it in state. Returns False if the stage failed. """
+        try:
+            if self.metrics is not None:
+                with self.metrics.measure(self.sampleName, stage.name, stage.inputs, stage.outputs):
+                    stage.function()
+            else:
+                stage.function()
+        except Exception as e:
+            print(e)
+            traceback.print_tb(e.__traceback__)
+            print(stage.error % (self.sampleName,))
+            return False
+
+        state.record(stage, self.settings)
+        return True
+
+    def getStages(self):
+        """ The essential pipeline is assembled here; stages are run in the order they are put into the list.
+        Beware that these processes depend on each other: Everyone expects the output file of the former one as input.
+        Every stage declares its input and output files and the configuration keys it depends on.
+        """
+        annotation = self.settings.get("GeneAnnotationFile")
+        reference = ["ReferenceGenomPath", "ReferenceGenomFile"]
+        native = self.settings.get("CountEngine") == "native"
+
+        # The unsorted bam is removed by sortBam
+        bamIntermediates = [] if native else [self.getFileName("5pFixed", ".bam", True)]
+
+        fixed = [self.getFileName("5pFixed", ".bam", True), self.getFileName("5pMisMatch", ".sam", True)]
+
+        if self.settings.get("StreamTrimAlign"):
+            # Trimming and alignment run as one pipe; with StreamFivePrimeFix the pipe also covers the 5' fix
+            archive = [self.getFileName(name, ".fastq") for name in self.settings.get("StreamArchive")]
+            fixing = self.settings.get("StreamFivePrimeFix")
+
+            stages = [
+                Stage(
+                    "trimAlign", self.runTrimAlign, "[Error] Failed to run cutadapt, bowtie or samtools for %s",
+                    inputs=[self.getFileName(None, ".fastq.gz")],
+                    outputs=(fixed if fixing else [self.getFileName("Aligned", ".sam", True)]) + archive,
+                    config=["SequenceAdapter3", "SequenceAdapter5"] + reference +
+                           ["StreamTrimAlign", "StreamArchive", "StreamFivePrimeFix"],
+                    intermediates=bamIntermediates if fixing else [],
+                    resource="align"
+                ),
+            ]
+        else:
+            stages = [
+                Stage(
+                    "cutadapters", self.runCutAdapters, "[Error] Failed to run cutadapt for %s",
+                    inputs=[self.getFileName(None, ".fastq.gz")],
+                    outputs=[
+                        self.getFileName("Trimmed", ".fastq"),
+                        self.getFileName("ModStop", ".fastq"),
+                        self.getFileName("AdaptStop", ".fastq"),
+                    ],
+                    config=["SequenceAdapter3", "SequenceAdapter5"],
+                    resource="io"
+                ),
+            ]
+
+            if self.settings.get("StreamFivePrimeFix"):
+                stages += [
+                    Stage(
+                        "bowtieAlignFix", self.runBowtieAlignFix,
+                        "[Error] Failed to run bowtie, fivePrimeFix or samtools for %s",
+                        inputs=[self.getFileName("ModStop", ".fastq")],
+                        outputs=fixed,
+                        config=reference + ["StreamFivePrimeFix"],
+                        intermediates=bamIntermediates,
+                        resource="align"
+                    ),
+                ]
+            else:
+                stages += [
+                    Stage(
+                        "bowtieAlign", self.runBowtieAlign, "[Error] Failed ro run bowtie for %s",
+                        inputs=[self.getFileName("ModStop", ".fastq")],
+                        outputs=[self.getFileName("Aligned", ".sam", True)],
+                        config=reference,
+                        resource="align"
+                    ),
+                ]
+
+        if not self.settings.get("StreamFivePrimeFix"):
+            stages += [
+                Stage(
+                    "fivePrimeFix", self.runFivePrimeFix, "[Error] Failed to run fivePrimeFix for %s",
+                    inputs=[self.getFileName("Aligned", ".sam", True)],
+                    outputs=[self.getFileName("5pFixed", ".sam", True), self.getFileName("5pMisMatch", ".sam", True)],
+                    config=["StreamFivePrimeFix"]
+                ),
+                Stage(
+                    "samToBam", self.runSamToBam, "[Error] Failed to run samtools for %s",
+                    inputs=[self.getFileName("5pFixed", ".sam", True)],
+                    outputs=[self.getFileName("5pFixed", ".bam", True)],
+                    intermediates=bamIntermediates,
+                    resource="io"
+                ),
+            ]
+
+        if native:
+            stages += [
+                Stage(
+                    "modcount", self.runNativeModCount, "[Error] Failed to run modCount for %s",
+                    inputs=[self.getFileName("5pFixed", ".bam", True), annotation],
+                    outputs=[self.getCountModFileName()],
+                    config=["GeneAnnotationFile", "CountEngine", "CountModFormat"]
+                ),
+            ]
+        else:
+            stages += [
+                Stage(
+                    "sortBam", self.runSortBam, "[Error] Failed to run samtools for %s",
+                    inputs=[self.getFileName("5pFixed", ".bam", True)],
+                    outputs=[self.getFileName("Sorted", ".bam", True)],
+                    resource="io"
+                ),
+                Stage(
+                    "intersect", self.runIntersect, "[Error] Failed to run BEDTools for %s",
+                    inputs=[self.getFileName("Sorted", ".bam", True), annotation],
+                    outputs=[self.getFileName("Intersect", ".tab", True)],
+                    config=["GeneAnnotationFile"],
+                    resource="io"
+                ),
+                Stage(
+                    "modcount", self.runModCount, "[Error] Failed to run modCount for %s",
+                    inputs=[self.getFileName("Intersect", ".tab", True)],
+                    outputs=[self.getCountModFileName()],
+                    config=["GeneAnnotationFile", "CountEngine", "ModCountParser", "CountModFormat"]
+                ),
+            ]
+
+        return stages
 
     def getFileName(self, prefix=None, extension=".fastq", ref=False):
         """ Calculates a standardized filename based on a few arguments:
@@ -70,7 +310,33 @@ class Sample():
                 # return os.path.join(*[self.settings.get("OutputDirectory"), suffix + "-" + + "_" + self.sampleName + extension])
 
     def pack(self, targetFile):
-        subprocess.check_output("gzip -f " + targetFile, shell=True)
+        """ Compresses an intermediate file according to the CompressionPolicy. With a compressor, the file is
+        compressed in the background; otherwise gzip is called. """
+        if not self.shouldPack():
+            return
+
+        if self.compressor is not None:
+            self.compressor.submit(targetFile)
+        else:
+            subprocess.check_output("gzip -f " + targetFile, shell=True)
+
+    def shouldPack(self):
+        """ Checks whether intermediate files should be compressed. auto only compresses if the free space of the
+        output directory falls below MinFreeScratchGB. """
+        policy = self.settings.get("CompressionPolicy")
+
+        if policy == "never":
+            return False
+        elif policy == "auto":
+            return freeSpace(self.settings.get("OutputDirectory")) < self.settings.get("MinFreeScratchGB") * 1024 ** 3
+        else:
+            return True
+
+    def unpack(self, targetFile):
+        """ Restores targetFile from its gzipped version if only that one exists, eg. when a stage is run again after
+        its input has been packed. """
+        if not os.path.exists(targetFile) and os.path.exists(targetFile + ".gz"):
+            subprocess.check_output("gzip -d -f " + targetFile + ".gz", shell=True)
 
     def runCutAdapters(self):
         """ Cuts the adapters from the sequence """
@@ -133,6 +399,7 @@ class Sample():
 
             cli = cli % (bowtie["threads"], bowtie["ref"], bowtie["in"], bowtie["out"])
 
+        self.unpack(bowtie["in"])
         subprocess.check_output(cli, shell=True)
 
         if useStar:
@@ -158,6 +425,144 @@ class Sample():
         # Delete not needed file
         #subprocess.check_output("rm -f %s" % sets["in"], shell=True)
 
+    def runBowtieAlignFix(self):
+        """ Runs bowtie, the 5' mismatch fix and samtools as a single pipe. bowtie writes to stdout, the fixed records
+        are streamed into samtools and only 5pFixed-*.bam and the 5pMisMatch side output are written. """
+        cliBowtie = "bowtie --best --chunkmbs 500 -p %d -t -S %s %s 2> %s"
+
+        sets = {
+            "threads": self.settings.get("MaxBowtieThreads"),
+            "ref": os.path.join(*[self.settings.get("ReferenceGenomPath"), self.settings.get("ReferenceGenomFile")]),
+            "in": self.getFileName("ModStop", ".fastq"),
+            "log": self.getFileName("Aligned", ".log", True),
+        }
+
+        cliBowtie = cliBowtie % (sets["threads"], sets["ref"], sets["in"], sets["log"])
+
+        self.unpack(sets["in"])
+        bowtie = subprocess.Popen(cliBowtie, shell=True, stdout=subprocess.PIPE, universal_newlines=True)
+        processes = [(bowtie, cliBowtie)]
+
+        try:
+            self.fixIntoBam(bowtie.stdout, processes)
+        finally:
+            closePipe(bowtie.stdout)
+            checkProcesses(processes)
+
+        self.pack(sets["in"])
+
+    def fixIntoBam(self, source, processes):
+        """ Runs the 5' mismatch fix on the SAM records read from source and streams the fixed records into samtools,
+        which writes 5pFixed-*.bam. The samtools process is added to processes so that the caller can check it
+        together with the rest of the pipe. """
+        cliSamtools = "samtools view -bS - > %s 2> %s" % (
+            self.getFileName("5pFixed", ".bam", True),
+            self.getFileName("5pFixed", ".log", True)
+        )
+
+        samtools = subprocess.Popen(cliSamtools, shell=True, stdin=subprocess.PIPE, universal_newlines=True)
+        processes.append((samtools, cliSamtools))
+
+        try:
+            with open(self.getFileName("5pMisMatch", ".sam", True), "w") as fhMis:
+                self.fixStream(source, samtools.stdin, fhMis)
+        finally:
+            closePipe(samtools.stdin)
+
+    def runTrimAlign(self):
+        """ Runs 3' trimming, 5' trimming with the separation of modstops and adapter stops, and bowtie as one chain
+        of pipes, without writing Trimmed, ModStop or AdaptStop as plain fastq files:
+
+            cutadapt -a | cutadapt -g (untrimmed -> /dev/fd/N) | bowtie
+
+        The untrimmed reads (mod stops) leave the 5' cutadapt through an anonymous pipe, passed to it as /dev/fd/N,
+        and are read from there by bowtie.
+        The side outputs listed in StreamArchive are written as .fastq.gz while the reads stream by. With
+        StreamFivePrimeFix, the chain goes on through the 5' fix into samtools; otherwise bowtie writes Aligned-*.sam.
+        Every process logs into its own file and the exit codes of all of them are checked. """
+        cli3 = "cutadapt -m 25 -a %s %s 2> %s"
+        cli5 = "cutadapt -g %s --untrimmed-output /dev/fd/%d -o %s - > %s 2>&1"
+        cliBowtie = "bowtie --best --chunkmbs 500 -p %d -t -S %s - %s 2> %s"
+
+        archive = self.settings.get("StreamArchive")
+        fixing = self.settings.get("StreamFivePrimeFix")
+
+        sets = {
+            "in": self.getFileName(None, ".fastq.gz"),
+            "threads": self.settings.get("MaxBowtieThreads"),
+            "ref": os.path.join(*[self.settings.get("ReferenceGenomPath"), self.settings.get("ReferenceGenomFile")]),
+            "log3": self.getFileName("Trimmed", ".log"),
+            "log5": self.getFileName("ModAdaptStop", ".log"),
+            "logBowtie": self.getFileName("Aligned", ".log", True),
+            "out": "" if fixing else self.getFileName("Aligned", ".sam", True),
+        }
+
+        sides = {}
+        for name in ("Trimmed", "AdaptStop", "ModStop"):
+            sides[name] = self.getFileName(name, ".fastq.gz") if name in archive else None
+
+            # An uncompressed leftover of a former run would shadow the new archive
+            if os.path.exists(self.getFileName(name, ".fastq")):
+                os.remove(self.getFileName(name, ".fastq"))
+
+        # The 5' trimming writes the modstops into a pipe of its own, which it opens as /dev/fd/N
+        modStopRead, modStopWrite = os.pipe()
+
+        processes = []
+        tees = []
+
+        try:
+            cli = cli3 % (self.settings.get("SequenceAdapter3"), sets["in"], sets["log3"])
+            cut3 = subprocess.Popen(cli, shell=True, stdout=subprocess.PIPE)
+            processes.append((cut3, cli))
+
+            cli = cli5 % (self.settings.get("SequenceAdapter5"), modStopWrite, sides["AdaptStop"] or "/dev/null",
+                          sets["log5"])
+            if sides["Trimmed"] is not None:
+                cut5 = subprocess.Popen(cli, shell=True, stdin=subprocess.PIPE, pass_fds=(modStopWrite,))
+                tees.append(Tee(cut3.stdout, [cut5.stdin], sides["Trimmed"]))
+            else:
+                cut5 = subprocess.Popen(cli, shell=True, stdin=cut3.stdout, pass_fds=(modStopWrite,))
+                cut3.stdout.close()
+            processes.append((cut5, cli))
+
+            os.close(modStopWrite)
+            modStopWrite = None
+
+            cli = cliBowtie % (sets["threads"], sets["ref"], sets["out"], sets["logBowtie"])
+            bowtieOut = subprocess.PIPE if fixing else None
+            if sides["ModStop"] is not None:
+                bowtie = subprocess.Popen(cli, shell=True, stdin=subprocess.PIPE, stdout=bowtieOut)
+                tees.append(Tee(os.fdopen(modStopRead, "rb"), [bowtie.stdin], sides["ModStop"]))
+            else:
+                bowtie = subprocess.Popen(cli, shell=True, stdin=modStopRead, stdout=bowtieOut)
+                os.close(modStopRead)
+            modStopRead = None
+            processes.append((bowtie, cli))
+
+            for tee in tees:
+                tee.start()
+
+            if fixing:
+                try:
+                    self.fixIntoBam(io.TextIOWrapper(bowtie.stdout), processes)
+                finally:
+                    closePipe(bowtie.stdout)
+        finally:
+            for fd in (modStopRead, modStopWrite):
+                if fd is not None:
+                    os.close(fd)
+
+            try:
+                checkProcesses(processes)
+            finally:
+                for tee in tees:
+                    tee.join()
+
+        for tee in tees:
+            if tee.error is not None:
+                raise tee.error
+
     def runSamToBam(self):
         cli = "samtools view -bS %s > %s 2> %s"
 
@@ -192,7 +597,9 @@ class Sample():
         cli = "intersectBed -s -wo -split -bed -abam %s -b %s %s > %s 2> %s"
 
         if intersectFile.endswith(".gff"):
-            cli2 = """| awk 'BEGIN { OFS = "\t";} {split($21,a,";"); sub(/ID=/,"",a[1]); print $1, $2, $3, $4, $6, $15, $16, $17, a[1]}' """
+            # A GFF annotation is intersected as its compiled BED6; the 1-based GFF start is restored for the .tab file
+            intersectFile = intersectAnnotation(intersectFile, self.settings.get("OutputDirectory"))
+            cli2 = """| awk 'BEGIN { OFS = "\t";} {print $1, $2, $3, $4, $6, $17, $14 + 1, $15, $16}' """
         elif intersectFile.endswith(".bed"):
             cli2 = """| awk 'BEGIN { OFS = "\t";} {print $1, $2, $3, $4, $6, "NA", $14, $15, $16}' """
         else:
@@ -212,16 +619,24 @@ class Sample():
         # inputfile = outputpath+"Intersect_"+ref+'_'+sampleName+'.tab'
         # outputfile = outputpath+"CountMod_"+ref+'_'+sampleName+".tab"
         inputfile = self.getFileName("Intersect", ".tab", True)
-        outputfile = self.getFileName("CountMod", ".tab", True)
+        outputfile = self.getCountModFileName()
 
-        intersectFile = self.settings.get("GeneAnnotationFile")
-        if intersectFile.endswith(".gff"):
-            intersectRefType = "gff"
-        elif intersectFile.endswith(".bed"):
-            intersectRefType = "bed"
+        intersectRefType = annotationType(self.settings.get("GeneAnnotationFile"))
+
+        if self.settings.get("ModCountParser") == "bulk":
+            genes = self.countIntersectBulk(inputfile, intersectRefType)
         else:
-            raise Exception("Can't determine gen annotation file format of %s" % intersectFile)
+            genes = self.countIntersect(inputfile, intersectRefType)
+
+        for gene_index in genes:
+            genes[gene_index].count = int(np.sum(genes[gene_index].countArray, dtype=np.int64))
+            genes[gene_index].countPerNt = float(genes[gene_index].count) / genes[gene_index].length
+            genes[gene_index].getDescription()
+
+        self.writeCountFile(genes, outputfile)
 
+    def countIntersect(self, inputfile, intersectRefType):
+        """ Counts the ModStops of an Intersect .tab file line by line. """
         fh = open(inputfile, 'r')
         genes = dict()
 
@@ -262,18 +677,179 @@ class Sample():
         # print genes[gene]
         fh.close()
 
-        for gene_index in genes:
-            genes[gene_index].count = sum(genes[gene_index].countArray)
-            genes[gene_index].countPerNt = float(genes[gene_index].count) / genes[gene_index].length
-            genes[gene_index].getDescription()
+        return genes
 
-        fh = open(outputfile, 'w')
-        mywriter = csv.writer(fh, delimiter=' ')
-        for gene_index in genes:
-            # if genes[gene].countPerNt > 1:
-            mywriter.writerow([">"] + genes[gene_index].description)
-            mywriter.writerow(genes[gene_index].countArray)
-        fh.close()
+    def countIntersectBulk(self, inputfile, intersectRefType):
+        """ Counts the ModStops of an Intersect .tab file in large chunks. Every chunk is split into typed columns,
+        the rows are grouped by gene and each gene's counts are added with a single bincount. The results are the
+        same as the ones of countIntersect, including the gene order. """
+        genes = dict()
+        offset = 0 if intersectRefType == "gff" else 1
+
+        with open(inputfile, "r") as fh:
+            rest = ""
+
+            while True:
+                chunk = fh.read(BULK_COUNT_CHUNK)
+                if not chunk:
+                    break
+
+                # Only parse complete lines, keep the incomplete last line for the next chunk
+                chunk = rest + chunk
+                end = chunk.rfind("\n") + 1
+                rest = chunk[end:]
+                self.countIntersectChunk(chunk[:end], genes, offset)
+
+            self.countIntersectChunk(rest, genes, offset)
+
+        return genes
+
+    def countIntersectChunk(self, chunk, genes, offset):
+        """ Adds the ModStops of a chunk of complete .tab lines to genes. offset is 1 for bed annotations. """
+        tokens = chunk.split()
+        if len(tokens) == 0:
+            return
+        if len(tokens) % 9 != 0:
+            raise Exception("Intersect file does not have 9 columns on every line")
+
+        readStart = intColumn(tokens[1::9])
+        readEnd = intColumn(tokens[2::9])
+        geneStart = intColumn(tokens[6::9])
+        geneEnd = intColumn(tokens[7::9])
+
+        # Only mod-stops inside of a gene are counted
+        rows = np.flatnonzero((readStart > geneStart) & (readEnd < geneEnd))
+        if len(rows) == 0:
+            return
+
+        strand = strandColumn(tokens[4::9])[rows]
+        readStart = readStart[rows]
+        readEnd = readEnd[rows]
+        geneStart = geneStart[rows]
+        geneEnd = geneEnd[rows]
+
+        # Group rows by start and end of the gene, and by name only if needed
+        names = np.array(tokens[8::9])[rows]
+        groups, first, groupIds = np.unique((geneStart << 32) | geneEnd, return_index=True, return_inverse=True)
+
+        if np.any(names != names[first][groupIds]):
+            nameIds = np.unique(names, return_inverse=True)[1]
+            groups, first, groupIds = np.unique(
+                np.column_stack((nameIds.ravel(), geneStart, geneEnd)),
+                axis=0,
+                return_index=True,
+                return_inverse=True
+            )
+        groupIds = groupIds.ravel()
+
+        plus = strand == b"+"
+        minus = strand == b"-"
+        positions = np.where(plus, readStart - geneStart - offset, geneEnd - readEnd - 1)
+
+        # Count all groups at once in a flat array, each group getting a slice of its gene length
+        lengths = geneEnd[first] - geneStart[first] + 1
+        starts = np.concatenate(([0], np.cumsum(lengths)))
+        counted = plus | minus
+        flat = np.bincount(starts[groupIds[counted]] + positions[counted], minlength=starts[-1])
+
+        # Create new genes in the order they first appear in the file
+        for group in np.argsort(first, kind="mergesort"):
+            row = rows[first[group]]
+            gene_index = tokens[9 * row + 8] + "_" + tokens[9 * row + 6] + "_" + tokens[9 * row + 7]
+
+            if gene_index not in genes:
+                genes[gene_index] = geneModCount(tokens[9 * row + 8], tokens[9 * row], *tokens[9 * row + 4:9 * row + 8])
+                genes[gene_index].countArray = np.zeros(genes[gene_index].length, np.int64)
+
+            genes[gene_index].countArray += flat[starts[group]:starts[group + 1]]
+
+    def runNativeModCount(self):
+        """ Counts ModStops without intersectBed. The alignments of the unsorted 5pFixed bam are assigned to the genes
+        of an in-process annotation index, following the same strand and inside-gene rules as runModCount. Sorting,
+        intersecting and the Intersect .tab file are not needed. """
+        cli = "samtools view -F 4 %s 2> %s"
+
+        sets = {
+            "in": self.getFileName("5pFixed", ".bam", True),
+            "out": self.getCountModFileName(),
+            "log": self.getFileName("CountMod", ".log", True),
+        }
+
+        annotation = loadAnnotation(self.settings.get("GeneAnnotationFile"), self.settings.get("OutputDirectory"))
+        genes = dict()
+        first = dict()
+
+        def assign(reads):
+            for (chromosome, strand), (starts, ends) in reads.items():
+                for feature, positions in annotation.assign(
+                        chromosome, strand, np.array(starts, np.int64), np.array(ends, np.int64)):
+                    gene_index = annotation.geneIndex(feature)
+
+                    if gene_index not in genes:
+                        gene = geneModCount(
+                            annotation.names[feature],
+                            chromosome,
+                            strand,
+                            annotation.types[feature],
+                            annotation.starts[feature],
+                            annotation.ends[feature]
+                        )
+                        gene.countArray = np.zeros(gene.length, np.int64)
+                        genes[gene_index] = gene
+
+                    first[gene_index] = min(feature, first.get(gene_index, feature))
+                    genes[gene_index].countArray += np.bincount(positions, minlength=genes[gene_index].length)
+
+        cli = cli % (sets["in"], sets["log"])
+        samtools = subprocess.Popen(cli, shell=True, stdout=subprocess.PIPE, universal_newlines=True)
+
+        try:
+            reads = dict()
+            i = 0
+
+            for line in samtools.stdout:
+                # QNAME FLAG RNAME POS MAPQ CIGAR ...
+                line = line.split("\t", 6)
+                strand = "-" if int(line[1]) & 16 else "+"
+                start = int(line[3]) - 1
+
+                if (line[2], strand) not in reads:
+                    reads[(line[2], strand)] = ([], [])
+                reads[(line[2], strand)][0].append(start)
+                reads[(line[2], strand)][1].append(start + cigarLength(line[5]))
+
+                i += 1
+                if i == NATIVE_COUNT_CHUNK:
+                    assign(reads)
+                    reads = dict()
+                    i = 0
+
+            assign(reads)
+        finally:
+            closePipe(samtools.stdout)
+            checkProcesses([(samtools, cli)])
+
+        # Keep the genes in annotation order
+        ordered = dict()
+        for gene_index in sorted(genes, key=lambda gene_index: first[gene_index]):
+            gene = genes[gene_index]
+            gene.count = int(gene.countArray.sum())
+            gene.countPerNt = float(gene.count) / gene.length
+            gene.getDescription()
+            ordered[gene_index] = gene
+
+        self.writeCountFile(ordered, sets["out"])
+
+    def writeCountFile(self, genes, outputfile):
+        """ Writes genes to a CountMod file, in the format given by the file extension. """
+        CountModStore.write(outputfile, genes)
+
+    def getCountModFileName(self):
+        """ Returns the name of the CountMod file in the configured format. """
+        if self.settings.get("CountModFormat") == "binary":
+            return self.getFileName("CountMod", CountModStore.BINARY_EXTENSION, True)
+        else:
+            return self.getFileName("CountMod", CountModStore.TEXT_EXTENSION, True)
 
     def wrapFix(self, inputfile, outputfile, mismatchfile):
         """ Taken from mod-seeker, need to rewrite """
@@ -284,20 +860,25 @@ class Sample():
             pass
 
         with open(inputfile, "r") as fhIn, open(outputfile, "a") as fhOut, open(mismatchfile, "a") as fhMis:
-            i = 0
-            mis = 0
-            writerOut = csv.writer(fhOut, delimiter="\t")
-            writerMis = csv.writer(fhMis, delimiter="\t")
-            # read lines, loop through file
-            for line in fhIn:
-                lineOrigin = line
-                lineStr, misCount = self.fix(line)
-                if line:
-                    fhOut.write(lineStr)
-                if misCount:
-                    fhMis.write(lineOrigin)
-                    mis += 1
-                i += 1
+            self.fixStream(fhIn, fhOut, fhMis)
+
+    def fixStream(self, fhIn, fhOut, fhMis):
+        """ Fixes every sam line read from fhIn and writes it to fhOut. Lines with a 5' mismatch are additionally
+        written unchanged to fhMis. Returns the number of lines and the number of mismatched lines. """
+        i = 0
+        mis = 0
+        # read lines, loop through file
+        for line in fhIn:
+            lineOrigin = line
+            lineStr, misCount = self.fix(line)
+            if line:
+                fhOut.write(lineStr)
+            if misCount:
+                fhMis.write(lineOrigin)
+                mis += 1
+            i += 1
+
+        return i, mis
 
     def fix(self, line):
         # sam file format example:
@@ -340,6 +921,11 @@ class Sample():
 
 
 class geneModCount(object):
+    """ Gene record of the counting stages. Counts start as a zeroed array('q'); the bulk and native counters replace
+    it by an int64 NumPy array. """
+    __slots__ = ("name", "chrms", "strain", "featureType", "Start", "End", "length", "count", "countPerNt",
+                 "countArray")
+
     def __init__(self, name, chrms, strain, featureType, posStart, posEnd):
         self.name = name
         self.chrms = chrms
@@ -350,10 +936,12 @@ class geneModCount(object):
         self.length = self.End - self.Start + 1
         self.count = "NA"
         self.countPerNt = "NA"
-        self.countArray = [0 for i in range(self.length)]
-        self.description = [self.name, self.chrms, self.strain, self.featureType, self.Start, self.End, self.length,
-                            self.count, self.countPerNt]
+        self.countArray = array.array("q", bytes(8 * max(self.length, 0)))
+
+    @property
+    def description(self):
+        return [self.name, self.chrms, self.strain, self.featureType, self.Start, self.End, self.length,
+                self.count, self.countPerNt]
 
     def getDescription(self):
-        self.description = [self.name, self.chrms, self.strain, self.featureType, self.Start, self.End, self.length,
-                            self.count, self.countPerNt]
+        return self.description
@@ -0,0 +1,126 @@
+import threading
+import traceback
+
+
+class Task:
+    """ A single (sample, stage) unit of work. Tasks of a sample form a chain: a task can only start once its
+    predecessor is done. """
+    WAITING = "waiting"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+    sampleName = None
+    stageName = None
+    resource = None
+    function = None
+    status = WAITING
+
+    def __init__(self, sampleName, stageName, resource, function):
+        self.sampleName = sampleName
+        self.stageName = stageName
+        self.resource = resource
+        self.function = function
+        self.status = Task.WAITING
+        self.error = None
+
+
+class StageScheduler:
+    """ Runs the stages of many samples on a pool of worker threads.
+
+    Every chain of tasks belongs to one sample and is run in order, but tasks of different samples interleave freely.
+    limits maps a resource name to the number of tasks of that resource that may run at the same time; resources
+    without a limit are only limited by the number of workers. Ready tasks of earlier chains are preferred, so samples
+    get completed in the order they were added. A failing task only stops the rest of its own chain. """
+    workers = 1
+
+    def __init__(self, workers, limits=None):
+        self.workers = workers
+        self.limits = dict(limits or {})
+        self.running = {}
+        self.chains = []
+        self.condition = threading.Condition()
+        self.onChainDone = None
+
+    def add_chain(self, tasks):
+        """ Adds the ordered tasks of a sample. """
+        self.chains.append(list(tasks))
+
+    def run(self, onChainDone=None):
+        """ Runs all tasks and blocks until they are done. onChainDone(tasks) is called whenever a chain has been
+        completed or has failed. Returns the list of failed tasks. """
+        self.onChainDone = onChainDone
+
+        threads = [threading.Thread(target=self.run_worker) for i in range(0, self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return [task for chain in self.chains for task in chain if task.status == Task.FAILED]
+
+    def run_worker(self):
+        """ Worker loop: takes the next ready task until no task is left. """
+        while True:
+            with self.condition:
+                task = self.next_task()
+                while task is None and not self.is_finished():
+                    self.condition.wait()
+                    task = self.next_task()
+
+                if task is None:
+                    return
+
+                task.status = Task.RUNNING
+                self.running[task.resource] = self.running.get(task.resource, 0) + 1
+
+            try:
+                succeeded = task.function()
+            except Exception as e:
+                task.error = e
+                traceback.print_exc()
+                succeeded = False
+
+            with self.condition:
+                self.running[task.resource] -= 1
+                task.status = Task.DONE if succeeded is not False else Task.FAILED
+                chain = self.find_chain(task)
+
+                if task.status == Task.FAILED:
+                    for other in chain:
+                        if other.status == Task.WAITING:
+                            other.status = Task.SKIPPED
+
+                chainDone = all(other.status != Task.WAITING and other.status != Task.RUNNING for other in chain)
+                self.condition.notify_all()
+
+            if chainDone and self.onChainDone is not None:
+                self.onChainDone(chain)
+
+    def next_task(self):
+        """ Returns the first task that is ready and whose resource is not exhausted, or None. """
+        for chain in self.chains:
+            for task in chain:
+                if task.status == Task.WAITING:
+                    limit = self.limits.get(task.resource)
+                    if limit is None or self.running.get(task.resource, 0) < limit:
+                        return task
+                    break
+                elif task.status != Task.DONE:
+                    break
+
+        return None
+
+    def is_finished(self):
+        for chain in self.chains:
+            for task in chain:
+                if task.status == Task.WAITING or task.status == Task.RUNNING:
+                    return False
+        return True
+
+    def find_chain(self, task):
+        for chain in self.chains:
+            if task in chain:
+                return chain
@@ -1,5 +1,41 @@
+import collections
 import math
-import scipy.stats
+import numpy as np
+import scipy.special
+
+
+class TableCache:
+    """ Bounded cache of test results, keyed by the full (clamped) table tuple. The least recently used table is
+    evicted once size tables are stored. """
+    size = 0
+    hits = 0
+    misses = 0
+
+    def __init__(self, size):
+        self.size = size
+        self.tables = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Returns the stored result of a table, or None. """
+        result = self.tables.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.tables.move_to_end(key)
+
+        return result
+
+    def put(self, key, result):
+        self.tables[key] = result
+        if len(self.tables) > self.size:
+            self.tables.popitem(last=False)
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
 
 
 class StatMagician:
@@ -7,67 +43,201 @@ class StatMagician:
     FDR = 0.05
     OddsRatioThreshold = 1.5
     TAIL = 45
-
-    def __init__(self, dataList, FDR, OddsRatioThreshold):
+    engine = "scalar"
+    adjustMethod = "threshold"
+    cache = None
+    minTotalStops = 0
+    minGeneCount = 0
+    testedPositions = 0
+    skippedPositions = 0
+    skippedGenes = 0
+
+    def __init__(self, dataList, FDR, OddsRatioThreshold, engine="scalar", adjustMethod="threshold", cache=None,
+                 minTotalStops=0, minGeneCount=0):
         # Assert that data only comes in pairs
         assert len(dataList) % 2 == 0
 
         self.dataList = dataList
         self.FDR = FDR
         self.OddsRatioThreshold = OddsRatioThreshold
+        self.engine = engine
+        self.adjustMethod = adjustMethod
+        # TableCache shared by all genes of the run, or None to test every table
+        self.cache = cache
+        # Prefilter: positions with fewer stops summed over all samples, and genes with a smaller count in any sample
+        # are not tested. Their test array entries stay NA.
+        self.minTotalStops = minTotalStops
+        self.minGeneCount = minGeneCount
+        self.testedPositions = 0
+        self.skippedPositions = 0
+        self.skippedGenes = 0
 
     def run(self):
-        numOfSamples = len(self.dataList)
-        reps = len(self.dataList) // 2
         output = {}
 
+        for gene, data in self.runIter():
+            output[gene] = data
+
+        # Return
+        return output
+
+    def runIter(self):
+        """ Tests the genes one by one and yields (gene name, gene) as soon as the test array of a gene is complete,
+        so the caller can write and release it before the next gene is tested. """
         # Run one of the gene lists
         for gene in self.dataList[0]:
             # Check if the gene exists in ALL samples
             if self.checkGeneExistsInAllSamples(gene):
-                output[gene] = self.dataList[0][gene]
-                output[gene].testArray = ["NA" for i in range(0, output[gene].length)]
-
-                pvalues = []
-
-                for i in range(0, output[gene].length):
-                    counts = []
-                    array = []
-
-                    for j in range(0, numOfSamples):
-                        a = self.dataList[j][gene].countArray[i]
-                        b = self.dataList[j][gene].count
-
-                        array.append(max(a, 1))
-                        array.append(max(b, 1))
-                        counts.append(a)
-                        counts.append(b)
-
-                    if len(array) == 4:
-                        # 4 Samples
-                        (chi, p, OR, ORL, ORU) = self.testChisq(array)
-                    elif len(array) % 4 == 0:
-                        # n*4 samples
-                        (chi, p, OR, ORL, ORU) = self.testCMH(array)
-                    else:
-                        raise Exception("Number of sample files have to be a multiple of 4")
-
-                    output[gene].testArray[i] = list((chi, p, 'NA', OR, ORL, ORU)) + counts  # 'NA' is for p_adjusted
-                    pvalues.append(p)
-
-                p_sig = self.BHcontrol(pvalues)  # list pvalues has been sorted in BHcontrol
-
-                if p_sig != "NA":
-                    for i in range(0, output[gene].length):
-                        if output[gene].testArray[i][1] <= p_sig:
-                            j = pvalues.index(output[gene].testArray[i][1]) + 1  # rank
-                            output[gene].testArray[i][2] = output[gene].testArray[i][1] * output[gene].length / float(j)
-                        #else:
-                        #    print("p_sig stays NA for ", output[gene].name)
+                data = self.dataList[0][gene]
+
+                if not self.checkGeneCount(gene):
+                    data.testArray = ["NA" for i in range(0, data.length)]
+                    self.skippedGenes += 1
+                    self.skippedPositions += data.length
+                    yield gene, data
+                    continue
+
+                if self.engine == "vectorized":
+                    testArray, pvalues = self.testGeneVectorized(gene)
+                else:
+                    testArray, pvalues = self.testGene(gene)
+
+                data.testArray = testArray
+                self.testedPositions += len(pvalues)
+                self.skippedPositions += data.length - len(pvalues)
+                self.adjustPvalues(data, pvalues)
+
+                yield gene, data
+
+    def testGene(self, gene):
+        """ Tests every position of a gene on its own and returns the test array together with the list of
+        p-values of the tested positions. """
+        numOfSamples = len(self.dataList)
+        length = self.dataList[0][gene].length
+        testArray = ["NA" for i in range(0, length)]
+        pvalues = []
+
+        for i in range(0, length):
+            counts = []
+            array = []
+
+            for j in range(0, numOfSamples):
+                a = int(self.dataList[j][gene].countArray[i])
+                b = self.dataList[j][gene].count
+
+                array.append(max(a, 1))
+                array.append(max(b, 1))
+                counts.append(a)
+                counts.append(b)
+
+            if sum(counts[0::2]) < self.minTotalStops:
+                continue
+
+            (chi, p, OR, ORL, ORU) = self.testTable(array)
+
+            testArray[i] = list((chi, p, 'NA', OR, ORL, ORU)) + counts  # 'NA' is for p_adjusted
+            pvalues.append(p)
+
+        return testArray, pvalues
+
+    def testTable(self, array):
+        """ Tests a single position, looking the table up in the cache first. """
+        key = tuple(array) if self.cache is not None else None
+        if key is not None:
+            result = self.cache.get(key)
+            if result is not None:
+                return result
+
+        if len(array) == 4:
+            # 4 Samples
+            result = self.testChisq(array)
+        elif len(array) % 4 == 0:
+            # n*4 samples
+            result = self.testCMH(array)
+        else:
+            raise Exception("Number of sample files have to be a multiple of 4")
+
+        if key is not None:
+            self.cache.put(key, result)
+
+        return result
+
+    def testGeneVectorized(self, gene):
+        """ Tests all positions of a gene at once. The counts of every sample are put into a
+        (positions x samples) array, giving the same test array and p-values as testGene. """
+        numOfSamples = len(self.dataList)
+        length = self.dataList[0][gene].length
+
+        if numOfSamples % 2 != 0:
+            raise Exception("Number of sample files have to be a multiple of 4")
+
+        stops = np.empty((length, numOfSamples), np.int64)
+        totals = np.empty(numOfSamples, np.int64)
+        for j in range(0, numOfSamples):
+            stops[:, j] = self.dataList[j][gene].countArray
+            totals[j] = self.dataList[j][gene].count
+
+        # Clamp as in testGene; treated samples are even, controls uneven
+        tested = np.flatnonzero(stops.sum(axis=1) >= self.minTotalStops)
+        stops = stops[tested]
+
+        clamped = np.maximum(stops, 1).astype(np.float64)
+        clampedTotals = np.maximum(totals, 1).astype(np.float64)
+
+        a = clamped[:, 0::2]
+        b = np.broadcast_to(clampedTotals[0::2], a.shape)
+        c = clamped[:, 1::2]
+        d = np.broadcast_to(clampedTotals[1::2], c.shape)
+
+        if numOfSamples == 2:
+            (chi, p, OR, ORL, ORU) = self.testChisqArray(a[:, 0], b[:, 0], c[:, 0], d[:, 0])
+        else:
+            (chi, p, OR, ORL, ORU) = self.testCMHArray(a, b, c, d)
+
+        # Raw counts are reported as (stops, sum) pairs per sample
+        counts = np.empty((len(tested), 2 * numOfSamples), np.int64)
+        counts[:, 0::2] = stops
+        counts[:, 1::2] = totals
+
+        pvalues = p.tolist()
+        testArray = ["NA" for i in range(0, length)]
+        for i, values, raw in zip(tested.tolist(), np.column_stack((chi, p, OR, ORL, ORU)).tolist(), counts.tolist()):
+            testArray[i] = [values[0], values[1], 'NA', values[2], values[3], values[4]] + raw
+
+        return testArray, pvalues
+
+    def adjustPvalues(self, gene, pvalues):
+        """ Sets the adjusted p-values of a gene.
+
+        threshold: only positions passing the Benjamini-Hochberg threshold get an adjusted p-value.
+        rank: every position gets its monotone Benjamini-Hochberg q-value.
+
+        Only tested positions count, positions removed by the prefilter are NA. """
+        tested = [i for i in range(0, gene.length) if gene.testArray[i] != "NA"]
+        if len(tested) == 0:
+            return
+
+        if self.adjustMethod == "rank":
+            qvalues = self.BHadjust(pvalues)
+            for i, q in zip(tested, qvalues.tolist()):
+                gene.testArray[i][2] = q
+            return
+
+        p_sig = self.BHcontrol(pvalues)  # list pvalues has been sorted in BHcontrol
+
+        if p_sig != "NA":
+            for i in tested:
+                if gene.testArray[i][1] <= p_sig:
+                    j = pvalues.index(gene.testArray[i][1]) + 1  # rank
+                    gene.testArray[i][2] = gene.testArray[i][1] * len(tested) / float(j)
                 #else:
-                #    print("p_sig is NA for ", output[gene].name)
-        # Return
-        return output
+                #    print("p_sig stays NA for ", gene.name)
+        #else:
+        #    print("p_sig is NA for ", gene.name)
+
+    def checkGeneCount(self, geneName):
+        """ Returns True if the gene has at least minGeneCount stops in every sample. """
+        return all(sample[geneName].count >= self.minGeneCount for sample in self.dataList)
 
     def checkGeneExistsInAllSamples(self, geneName):
         """ geneName is the index used for every data dict in dataList """
@@ -91,6 +261,9 @@ class StatMagician:
             [b, d],
         ]
 
+        # Imported here, scipy.stats takes most of the import time of the stat routine
+        import scipy.stats
+
         chi, p, dof, details = scipy.stats.chi2_contingency(array, True)
 
         OR = (a * d) / (b * c)
@@ -158,6 +331,66 @@ class StatMagician:
 
         return (chi, pvalue, OR, ORL, ORU)
 
+    def testChisqArray(self, a, b, c, d):
+        """ Vectorized version of testChisq. a, b, c and d are float arrays holding one 2X2 table
+        per position. """
+        z = 1.959964
+        n = a + b + c + d
+
+        # Expected values of the contingency table
+        observed = (a, c, b, d)
+        expected = (
+            (a + c) * (a + b) / n,
+            (a + c) * (c + d) / n,
+            (b + d) * (a + b) / n,
+            (b + d) * (c + d) / n,
+        )
+
+        # Yates' continuity correction, the same way scipy.stats.chi2_contingency applies it
+        chi = np.zeros(n.shape)
+        for o, e in zip(observed, expected):
+            diff = e - o
+            o = o + np.minimum(0.5, np.abs(diff)) * np.sign(diff)
+            chi += (o - e) ** 2 / e
+
+        # Survival function of chi2 with one degree of freedom, what scipy.stats.chi2.sf computes
+        p = scipy.special.chdtrc(1, chi)
+
+        OR = (a * d) / (b * c)
+        SE = np.sqrt(1 / a + 1 / b + 1 / c + 1 / d)
+
+        ORL = OR * np.exp(-z * SE)
+        ORU = OR * np.exp(z * SE)
+
+        return chi, p, OR, ORL, ORU
+
+    def testCMHArray(self, a, b, c, d):
+        """ Vectorized version of testCMH. a, b, c and d are float arrays of shape (positions, replicates). """
+        n = a + b + c + d
+
+        chit1Sum = (a - (a + b) * (a + c) / n).sum(axis=1)
+        chit2Sum = ((a + b) * (a + c) * (b + d) * (c + d) / (n ** 3 - n ** 2)).sum(axis=1)
+
+        ORt1Sum = (a * d / n).sum(axis=1)
+        ORt2Sum = (b * c / n).sum(axis=1)
+
+        SEt1_nSum = ((a + d) * a * d / n ** 2).sum(axis=1)
+        SEt2_nSum = ((b + c) * b * c / n ** 2).sum(axis=1)
+        SEt3_nSum = (((a + d) * b * c + (b + c) * a * d) / n ** 2).sum(axis=1)
+
+        chi = (np.abs(chit1Sum) - 0.5) ** 2 / chit2Sum
+        OR = ORt1Sum / ORt2Sum
+        var = SEt1_nSum / (2 * ORt1Sum ** 2) + SEt2_nSum / (2 * ORt2Sum ** 2) + SEt3_nSum / (
+        2 * ORt1Sum * ORt2Sum)
+        SE = np.sqrt(var)
+        z = 1.959964
+        ORL = OR * np.exp(SE * (-z))
+        ORU = OR * np.exp(SE * z)
+
+        pvalue = 1 - scipy.special.erf(np.sqrt(0.5 * chi))
+
+        return (chi, pvalue, OR, ORL, ORU)
+
     def pchisq(self, x):
         """ Returns the p-value of a chi-sq test with df=1 """
         return 1 - math.erf(math.sqrt(0.5 * float(x)))
@@ -178,4 +411,21 @@ class StatMagician:
             # print "BHcontrol:", p_sig, m, i-1
             return p_sig
         else:
-            return 'NA'
\ No newline at end of file
+            return 'NA'
+
+    def BHadjust(self, pvalues):
+        """ Returns the Benjamini-Hochberg q-values of pvalues in their original order.
+
+        Sorting once makes this O(n log n): q(k) = min(p(j) * m / j) over all ranks j >= k. """
+        pvalues = np.asarray(pvalues, np.float64)
+        m = len(pvalues)
+        if m == 0:
+            return pvalues
+
+        order = np.argsort(pvalues, kind="mergesort")
+        ranked = pvalues[order] * m / np.arange(1, m + 1)
+        ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+
+        qvalues = np.empty(m, np.float64)
+        qvalues[order] = np.minimum(ranked, 1.0)
+        return qvalues
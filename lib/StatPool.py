@@ -0,0 +1,147 @@
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from lib.StatMagician import StatMagician, TableCache
+
+# Number of shards handed out per worker, more shards balance uneven gene lengths better
+SHARDS_PER_WORKER = 4
+
+# Shared state of a worker process, set by init_worker
+worker = {}
+
+
+class SharedGene:
+    """ Minimal gene record used inside the workers. It carries only what StatMagician needs. """
+    __slots__ = ("countArray", "count", "length", "testArray")
+
+    def __init__(self, countArray, count, length):
+        self.countArray = countArray
+        self.count = count
+        self.length = length
+        self.testArray = None
+
+
+def init_worker(shmName, shape, options, prefilter, cacheSize):
+    """ Attaches a worker process to the shared count arrays. The test cache lives as long as the worker. """
+    worker["shm"] = shared_memory.SharedMemory(name=shmName)
+    worker["counts"] = np.ndarray(shape, np.int64, buffer=worker["shm"].buf)
+    worker["options"] = options
+    worker["prefilter"] = prefilter
+    worker["cache"] = TableCache(cacheSize) if cacheSize > 0 else None
+
+
+def test_shard(shard):
+    """ Tests all genes of a shard and returns their test arrays in shard order, together with the counters of the
+    shard: cache hits and misses, tested and skipped positions and skipped genes.
+
+    shard is a list of (gene index, offset, length, totals) tuples, offset pointing into the shared count arrays. """
+    counts = worker["counts"]
+    numOfSamples = counts.shape[0]
+    dataList = [{} for j in range(0, numOfSamples)]
+
+    for gene, offset, length, totals in shard:
+        for j in range(0, numOfSamples):
+            dataList[j][gene] = SharedGene(counts[j, offset:offset + length].tolist(), totals[j], length)
+
+    cache = worker["cache"]
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+
+    magic = StatMagician(dataList, *worker["options"], cache=cache, **worker["prefilter"])
+    output = magic.run()
+
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+
+    counters = (hits, misses, magic.testedPositions, magic.skippedPositions, magic.skippedGenes)
+    return [output[gene].testArray for gene, offset, length, totals in shard], counters
+
+
+class StatPool:
+    """ Runs StatMagician on shards of the common gene set in a process pool.
+
+    The count arrays of all samples are copied once into shared memory, the workers only receive gene offsets.
+    Results are collected in the gene order of the first sample, so the output does not depend on the number
+    of workers. """
+    dataList = None
+    workers = 1
+    cacheSize = 0
+    cache = None
+    testedPositions = 0
+    skippedPositions = 0
+    skippedGenes = 0
+
+    def __init__(self, dataList, FDR, OddsRatioThreshold, engine="scalar", adjustMethod="threshold", workers=1,
+                 cacheSize=0, minTotalStops=0, minGeneCount=0):
+        assert len(dataList) % 2 == 0
+
+        self.dataList = dataList
+        self.options = (FDR, OddsRatioThreshold, engine, adjustMethod)
+        self.prefilter = {"minTotalStops": minTotalStops, "minGeneCount": minGeneCount}
+        self.workers = workers
+        self.cacheSize = cacheSize
+        # Counters summed over all workers
+        self.cache = TableCache(cacheSize) if cacheSize > 0 else None
+        self.testedPositions = 0
+        self.skippedPositions = 0
+        self.skippedGenes = 0
+
+    def run(self):
+        output = {}
+
+        for gene, data in self.runIter():
+            output[gene] = data
+
+        return output
+
+    def runIter(self):
+        """ Yields (gene name, gene) in the order of run, shard by shard as the shards are finished. """
+        genes = [gene for gene in self.dataList[0] if all(gene in sample for sample in self.dataList)]
+        lengths = [self.dataList[0][gene].length for gene in genes]
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        shape = (len(self.dataList), int(offsets[-1]))
+
+        shm = shared_memory.SharedMemory(create=True, size=max(1, shape[0] * shape[1] * 8))
+        try:
+            counts = np.ndarray(shape, np.int64, buffer=shm.buf)
+            for j, sample in enumerate(self.dataList):
+                for i, gene in enumerate(genes):
+                    counts[j, offsets[i]:offsets[i + 1]] = sample[gene].countArray
+            del counts
+
+            shards = self.make_shards(genes, lengths, offsets)
+            initargs = (shm.name, shape, self.options, self.prefilter, self.cacheSize)
+
+            with multiprocessing.Pool(self.workers, init_worker, initargs) as pool:
+                for shard, (testArrays, counters) in zip(shards, pool.imap(test_shard, shards)):
+                    (hits, misses, tested, skipped, skippedGenes) = counters
+                    if self.cache is not None:
+                        self.cache.hits += hits
+                        self.cache.misses += misses
+                    self.testedPositions += tested
+                    self.skippedPositions += skipped
+                    self.skippedGenes += skippedGenes
+
+                    for (i, offset, length, totals), testArray in zip(shard, testArrays):
+                        data = self.dataList[0][genes[i]]
+                        data.testArray = testArray
+                        yield genes[i], data
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def make_shards(self, genes, lengths, offsets):
+        """ Splits the genes into contiguous shards of roughly the same number of positions. """
+        numOfShards = max(1, min(len(genes), self.workers * SHARDS_PER_WORKER))
+        target = offsets[-1] / numOfShards
+        shards = [[]]
+
+        for i, gene in enumerate(genes):
+            if len(shards[-1]) > 0 and offsets[i] >= target * len(shards):
+                shards.append([])
+
+            totals = [sample[gene].count for sample in self.dataList]
+            shards[-1].append((i, int(offsets[i]), lengths[i], totals))
+
+        return shards
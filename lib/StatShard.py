@@ -0,0 +1,91 @@
+""" Sharded stat runs.
+
+stat --shard i/N only tests the common genes whose key (name_start_end) falls into shard i of N, and writes the
+significant positions to a partial file in the output directory. stat-merge combines the partial files of all N
+shards into a regular output_stats_*.csv.
+
+A partial file starts with a metadata line (# followed by JSON) holding the shard, the number of shards and a
+fingerprint of the input files and the configuration. It is followed by the header and the rows of writeData, each
+prefixed by the ordinal of its gene among all common genes, so the merge can restore the original gene order.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import zlib
+
+PARTIAL_PATTERN = "output_stats_shard-{}-of-{}.partial"
+ORDINAL_COLUMN = "gene_ordinal"
+
+# Options that change the results. Options that only change how fast they are computed are left out.
+FINGERPRINT_OPTIONS = [
+    "FDR",
+    "OddsRatioThreshold",
+    "NumberOfReplicates",
+    "TestEngine",
+    "PAdjustMethod",
+    "MinTotalStops",
+    "MinGeneCount",
+]
+
+
+def parseShard(value):
+    """ Parses i/N into (i, N), i counting from 1. """
+    try:
+        index, count = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise Exception("Expected a shard as i/N, got " + value)
+
+    if count < 1 or index < 1 or index > count:
+        raise Exception("Shard %s is out of range, i must be between 1 and N" % value)
+
+    return index, count
+
+
+def inShard(key, index, count):
+    """ Returns True if the gene key belongs to shard index of count. crc32 is stable across runs and machines. """
+    return zlib.crc32(key.encode("utf-8")) % count == index - 1
+
+
+def partialFilename(directory, index, count):
+    return os.path.join(directory, PARTIAL_PATTERN.format(index, count))
+
+
+def findPartials(directory):
+    return sorted(glob.glob(os.path.join(directory, PARTIAL_PATTERN.format("*", "*"))))
+
+
+def fileHash(filename):
+    sha1 = hashlib.sha1()
+
+    with open(filename, "rb") as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b""):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+def fingerprint(settings, tail):
+    """ Hashes the content of the input files, in treated/control order, together with the options that change the
+    results. """
+    files = [filename for pair in settings.get("files") for filename in pair]
+    state = {
+        "files": [[os.path.basename(filename), fileHash(filename)] for filename in files],
+        "options": {key: settings.get(key) for key in FINGERPRINT_OPTIONS},
+        "tail": tail,
+    }
+
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def writeMetadata(fh, index, count, fingerprint):
+    fh.write("#" + json.dumps({"shard": index, "shards": count, "fingerprint": fingerprint}) + "\n")
+
+
+def readMetadata(fh):
+    line = fh.readline()
+    if not line.startswith("#"):
+        raise Exception(fh.name + " is not a partial stat file")
+
+    return json.loads(line[1:])
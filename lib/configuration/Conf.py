@@ -5,6 +5,16 @@ def expandFilename(filename):
     return os.path.expanduser(os.path.expandvars(filename))
 
 
+def readSwitch(value):
+    """ Converts a yes/no option into a boolean. """
+    if value.lower() in ("yes", "true", "on", "1"):
+        return True
+    elif value.lower() in ("no", "false", "off", "0"):
+        return False
+    else:
+        raise Exception("Expected yes or no, got " + value)
+
+
 class Reader:
     filename = None
     config = {}
@@ -23,6 +33,13 @@ class Reader:
         else:
             raise Exception("key not found")
 
+    def get_or_default(self, key, default):
+        """ Returns the value of an optional key, or default if the key has not been set. """
+        if key in self.config:
+            return self.config[key]
+        else:
+            return default
+
     def parse(self):
         with open(self.filename, "r") as fh:
             for line in fh:
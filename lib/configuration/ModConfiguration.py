@@ -14,6 +14,20 @@ class ModConfiguration():
         "InputDirectory": None,
         "MaxPythonThreads": None,
         "MaxBowtieThreads": None,
+        "StreamFivePrimeFix": False,
+        "StreamTrimAlign": False,
+        "StreamArchive": ["AdaptStop", "ModStop"],
+        "CountEngine": "intersect",
+        "ModCountParser": "line",
+        "CountModFormat": "text",
+        "Scheduler": "sample",
+        "MaxAlignJobs": 1,
+        "MaxIOJobs": 0,
+        "CompressionPolicy": "always",
+        "CompressionThreads": 4,
+        "MinFreeScratchGB": 50,
+        "Distributed": False,
+        "LeaseTimeout": 300,
     }
 
     def __init__(self, confFile):
@@ -64,6 +78,55 @@ class ModConfiguration():
         self.config["MaxPythonThreads"] = int(reader.get("MaxPythonThreads"))
         self.config["MaxBowtieThreads"] = int(reader.get("MaxBowtieThreads"))
 
+        # Optional options
+        self.config["StreamFivePrimeFix"] = Conf.readSwitch(reader.get_or_default("StreamFivePrimeFix", "no"))
+        self.config["StreamTrimAlign"] = Conf.readSwitch(reader.get_or_default("StreamTrimAlign", "no"))
+
+        # Side outputs of the streamed trimming that are kept as .fastq.gz
+        archive = reader.get_or_default("StreamArchive", "AdaptStop, ModStop")
+        self.config["StreamArchive"] = [x.strip() for x in archive.split(",") if x.strip() != ""]
+        for name in self.config["StreamArchive"]:
+            if name not in ("Trimmed", "AdaptStop", "ModStop"):
+                raise Exception("StreamArchive may only contain Trimmed, AdaptStop and ModStop")
+
+        self.config["CountEngine"] = reader.get_or_default("CountEngine", "intersect")
+        if self.config["CountEngine"] not in ("intersect", "native"):
+            raise Exception("CountEngine must be either intersect or native")
+
+        self.config["ModCountParser"] = reader.get_or_default("ModCountParser", "line")
+        if self.config["ModCountParser"] not in ("line", "bulk"):
+            raise Exception("ModCountParser must be either line or bulk")
+
+        self.config["CountModFormat"] = reader.get_or_default("CountModFormat", "text")
+        if self.config["CountModFormat"] not in ("text", "binary"):
+            raise Exception("CountModFormat must be either text or binary")
+
+        self.config["Scheduler"] = reader.get_or_default("Scheduler", "sample")
+        if self.config["Scheduler"] not in ("sample", "stage"):
+            raise Exception("Scheduler must be either sample or stage")
+
+        # Limits of the stage scheduler; 0 for MaxIOJobs only limits by MaxPythonThreads
+        self.config["MaxAlignJobs"] = int(reader.get_or_default("MaxAlignJobs", 1))
+        self.config["MaxIOJobs"] = int(reader.get_or_default("MaxIOJobs", 0))
+        if self.config["MaxAlignJobs"] < 1:
+            raise Exception("MaxAlignJobs must be at least 1")
+
+        # Compression of intermediate files: always, never, or auto (only when scratch space runs low)
+        self.config["CompressionPolicy"] = reader.get_or_default("CompressionPolicy", "always")
+        if self.config["CompressionPolicy"] not in ("always", "never", "auto"):
+            raise Exception("CompressionPolicy must be always, never or auto")
+
+        self.config["CompressionThreads"] = int(reader.get_or_default("CompressionThreads", 4))
+        self.config["MinFreeScratchGB"] = float(reader.get_or_default("MinFreeScratchGB", 50))
+
+        # Several hosts sharing InputDirectory and OutputDirectory claim whole samples through lease files
+        self.config["Distributed"] = Conf.readSwitch(reader.get_or_default("Distributed", "no"))
+        self.config["LeaseTimeout"] = int(reader.get_or_default("LeaseTimeout", 300))
+        if self.config["LeaseTimeout"] < 10:
+            raise Exception("LeaseTimeout must be at least 10 seconds")
+        if self.config["Distributed"] and self.config["Scheduler"] != "sample":
+            raise Exception("Distributed mode runs whole samples, Scheduler must be sample")
+
     def writeDefaultConfig(self, confFile):
         writer = Conf.Writer(confFile)
 
@@ -76,6 +139,20 @@ class ModConfiguration():
         writer.set("InputDirectory", "~/QURAlkData/Input")
         writer.set("MaxPythonThreads", 4)
         writer.set("MaxBowtieThreads", 2)
+        writer.set("StreamFivePrimeFix", "no")
+        writer.set("StreamTrimAlign", "no")
+        writer.set("StreamArchive", "AdaptStop, ModStop")
+        writer.set("CountEngine", "intersect")
+        writer.set("ModCountParser", "line")
+        writer.set("CountModFormat", "text")
+        writer.set("Scheduler", "sample")
+        writer.set("MaxAlignJobs", 1)
+        writer.set("MaxIOJobs", 0)
+        writer.set("CompressionPolicy", "always")
+        writer.set("CompressionThreads", 4)
+        writer.set("MinFreeScratchGB", 50)
+        writer.set("Distributed", "no")
+        writer.set("LeaseTimeout", 300)
 
         writer.write()
 
@@ -1,13 +1,39 @@
 import os
 
+from lib import CountModStore
 from . import Conf
 
 
+def resolveCountFile(fileSearchPath, fileItem):
+    """ Returns the full path of a CountMod file. If the file exists both in text and binary format, the more
+    recently written one is used. """
+    candidates = []
+
+    for extension in (CountModStore.TEXT_EXTENSION, CountModStore.BINARY_EXTENSION):
+        fullFile = Conf.expandFilename(os.path.join(*[fileSearchPath, fileItem + extension]))
+        if os.path.exists(fullFile):
+            candidates.append((os.path.getmtime(fullFile), fullFile))
+
+    if len(candidates) == 0:
+        raise Exception(Conf.expandFilename(os.path.join(*[fileSearchPath, fileItem + ".tab"])) + " does not exist")
+
+    return max(candidates)[1]
+
+
 class StatConfiguration():
     config = {
         "FDR": None,
         "OddsRatioThreshold": None,
         "NumberOfReplicates": None,
+        "TestEngine": "scalar",
+        "PAdjustMethod": "threshold",
+        "StatWorkers": 1,
+        "LoadWorkers": 0,
+        "HistoWorkers": 1,
+        "TestCacheSize": 65536,
+        "MinTotalStops": 0,
+        "MinGeneCount": 0,
+        "StreamResults": False,
         "files": None,
     }
 
@@ -36,6 +62,44 @@ class StatConfiguration():
         self.config["OddsRatioThreshold"] = float(reader.get("OddsRatioThreshold"))
         self.config["NumberOfReplicates"] = int(reader.get("NumberOfReplicates"))
 
+        # Optional options
+        self.config["TestEngine"] = reader.get_or_default("TestEngine", "scalar")
+        if self.config["TestEngine"] not in ("scalar", "vectorized"):
+            raise Exception("TestEngine must be either scalar or vectorized")
+
+        self.config["PAdjustMethod"] = reader.get_or_default("PAdjustMethod", "threshold")
+        if self.config["PAdjustMethod"] not in ("threshold", "rank"):
+            raise Exception("PAdjustMethod must be either threshold or rank")
+
+        self.config["StatWorkers"] = int(reader.get_or_default("StatWorkers", 1))
+        if self.config["StatWorkers"] < 1:
+            raise Exception("StatWorkers must be at least 1")
+
+        # 0 loads all files at once, limited by the number of CPUs
+        self.config["LoadWorkers"] = int(reader.get_or_default("LoadWorkers", 0))
+        if self.config["LoadWorkers"] < 0:
+            raise Exception("LoadWorkers must not be negative")
+
+        # Processes drawing histograms; 0 uses one per CPU
+        self.config["HistoWorkers"] = int(reader.get_or_default("HistoWorkers", 1))
+        if self.config["HistoWorkers"] < 0:
+            raise Exception("HistoWorkers must not be negative")
+
+        # Number of test results kept for repeated tables; 0 disables the cache
+        self.config["TestCacheSize"] = int(reader.get_or_default("TestCacheSize", 65536))
+        if self.config["TestCacheSize"] < 0:
+            raise Exception("TestCacheSize must not be negative")
+
+        # Prefilter, 0 tests every position. Positions with fewer stops summed over all samples and genes with
+        # fewer stops in any sample are not tested.
+        self.config["MinTotalStops"] = int(reader.get_or_default("MinTotalStops", 0))
+        self.config["MinGeneCount"] = int(reader.get_or_default("MinGeneCount", 0))
+        if self.config["MinTotalStops"] < 0 or self.config["MinGeneCount"] < 0:
+            raise Exception("MinTotalStops and MinGeneCount must not be negative")
+
+        # Write every gene as soon as it is tested instead of keeping all results until the end
+        self.config["StreamResults"] = Conf.readSwitch(reader.get_or_default("StreamResults", "no"))
+
         # Read files
         treatedFiles = [x.strip() for x in reader.get("treatedFiles").split(",")]
         controlFiles = [x.strip() for x in reader.get("controlFiles").split(",")]
@@ -50,16 +114,10 @@ class StatConfiguration():
 
         # Check files
         for fileItem in treatedFiles:
-            fullFile = Conf.expandFilename(os.path.join(*[fileSearchPath, fileItem + ".tab"]))
-            if not os.path.exists(fullFile):
-                raise Exception(fullFile + " does not exist")
-            treatedFilesFull.append(fullFile)
+            treatedFilesFull.append(resolveCountFile(fileSearchPath, fileItem))
 
         for fileItem in controlFiles:
-            fullFile = Conf.expandFilename(os.path.join(*[fileSearchPath, fileItem + ".tab"]))
-            if not os.path.exists(fullFile):
-                raise Exception(fullFile + " does not exist")
-            controlFilesFull.append(fullFile)
+            controlFilesFull.append(resolveCountFile(fileSearchPath, fileItem))
 
         # Store files
         self.config["files"] = []
@@ -72,6 +130,15 @@ class StatConfiguration():
         writer.set("FDR", 0.05)
         writer.set("OddsRatioThreshold", 1.5)
         writer.set("NumberOfReplicates", 2)
+        writer.set("TestEngine", "scalar")
+        writer.set("PAdjustMethod", "threshold")
+        writer.set("StatWorkers", 1)
+        writer.set("LoadWorkers", 0)
+        writer.set("HistoWorkers", 1)
+        writer.set("TestCacheSize", 65536)
+        writer.set("MinTotalStops", 0)
+        writer.set("MinGeneCount", 0)
+        writer.set("StreamResults", "no")
         writer.set("treatedFiles", "file1a, file2a")
         writer.set("controlFiles", "file1b, file2b")
 
@@ -0,0 +1,41 @@
+import os
+
+from lib import CountModStore
+from lib.Routines import get_routine_help
+
+from .BaseRoutine import BaseRoutine
+
+
+class ConvertRoutine(BaseRoutine):
+    def get_cli_help(self):
+        return get_routine_help("convert")
+
+    def get_more_cli_help(self):
+        return """Converts a CountMod file created by mod between the text (.tab) and the
+binary, memory-mappable (.cmb) format. The format is chosen by the file extension.
+
+$ quralk-pipe convert CountMod-s_cer_sample.tab CountMod-s_cer_sample.cmb
+
+If only the source file is given, the file is converted into the other format
+next to the source file."""
+
+    def run(self):
+        if len(self.arguments) == 0 or len(self.arguments) > 2:
+            print(self.get_more_cli_help())
+            return
+
+        source = self.arguments[0]
+
+        if len(self.arguments) == 2:
+            target = self.arguments[1]
+        elif CountModStore.isBinary(source):
+            target = os.path.splitext(source)[0] + CountModStore.TEXT_EXTENSION
+        else:
+            target = os.path.splitext(source)[0] + CountModStore.BINARY_EXTENSION
+
+        if not os.path.exists(source):
+            raise Exception(source + " does not exist")
+
+        genes = CountModStore.convert(source, target)
+
+        print("Converted %i genes from %s to %s" % (genes, source, target))
@@ -1,22 +1,137 @@
 
+import collections
 import datetime
+import hashlib
+import json
 import matplotlib
 matplotlib.use('cairo')
 
 import matplotlib.pyplot as plt
+import itertools
+import multiprocessing
 import os
 import math
 
+import numpy as np
+
 from lib.configuration.ModConfiguration import ModConfiguration
 from lib.configuration.StatConfiguration import StatConfiguration
+from lib.Routines import get_routine_help
 from .StatRoutine import StatRoutine
 
+# Number of histograms handed to a worker process at once
+HISTO_CHUNKSIZE = 4
+
+# Number of genes whose count arrays are built at once
+HISTO_BATCH = 512
+
+# Remembers the inputs every histogram has been drawn from
+HISTO_MANIFEST = "histogram_manifest.json"
+
+BAR_WIDTH = 1.0
+MIN_YLIMIT = 100
+
+# State of a histogram worker process
+worker = {}
+
+
+def plotSettings():
+    """ Everything besides the counts that changes how a histogram looks. """
+    return "%s;%s;%s;%s" % (BAR_WIDTH, MIN_YLIMIT, matplotlib.get_backend(), matplotlib.__version__)
+
+
+def histogramHash(counts, description, settings):
+    """ Hashes the (samples x positions) counts of a gene together with the description fields that are shown and the
+    plot settings. """
+    digest = hashlib.sha1()
+    digest.update(("%s;%s;%s" % (description, counts.shape, settings)).encode())
+    digest.update(np.ascontiguousarray(counts, "<i8").tobytes())
+    return digest.hexdigest()
+
+
+def readManifest(filename):
+    """ Returns the gene -> hash map of the histograms drawn so far. """
+    if not os.path.exists(filename):
+        return {}
+
+    try:
+        with open(filename, "r") as fh:
+            return json.load(fh)["genes"]
+    except (ValueError, KeyError):
+        # A broken manifest only means that everything is drawn again
+        return {}
+
+
+def writeManifest(filename, genes):
+    with open(filename + ".tmp", "w") as fh:
+        json.dump({"genes": genes}, fh, indent=0, sort_keys=True)
+    os.replace(filename + ".tmp", filename)
+
+
+def init_worker():
+    """ Creates the figure a worker process draws all of its histograms into. """
+    worker["renderer"] = HistogramRenderer()
+
+
+def render_histograms(chunk):
+    return [worker["renderer"].render(histogram) for histogram in chunk]
+
+
+class HistogramRenderer:
+    """ Draws histograms into a single figure that is created once and cleared for every gene, instead of creating
+    (and leaking) a new figure per gene. """
+    figure = None
+    axes = None
+
+    def __init__(self):
+        self.figure, self.axes = plt.subplots(3, sharex=True, sharey=True)
+
+    def render(self, histogram):
+        """ Draws and saves one histogram, given as (name, chrms, start, length, treated, control, difference,
+        filename). Returns the filename. """
+        name, chrms, start, length, count_average_treated, count_average_control, count_average_difference, \
+            filename = histogram
+        ax1, ax2, ax3 = self.axes
+
+        for ax in self.axes:
+            ax.cla()
+
+        width = BAR_WIDTH
+        pos = range(start, start + length)
+
+        ax1.bar(pos, count_average_treated, width)
+        ax1.set_xlim(start, start + length)
+        ax1.set_xlabel("Position")
+        ax1.set_ylabel("counts")
+        ax1.set_ylim(min(0, min(count_average_difference)),
+                     max(max(max(count_average_treated), max(count_average_control)), MIN_YLIMIT))
+        ax1.set_title("Gene %s on chromosome %s" % (name, chrms))
+
+        ax2.bar(pos, count_average_control, width)
+        ax3.bar(pos, count_average_difference, width)
+
+        self.figure.subplots_adjust(hspace=0)
+        plt.setp([a.get_xticklabels() for a in self.axes[:-1]], visible=False)
+
+        self.figure.savefig(filename)
+
+        return filename
+
+    def close(self):
+        plt.close(self.figure)
+
 
 class DataList:
+    """ Gives access to the genes of all treated (even) and control (uneven) samples.
+
+    The counts of a gene are kept as a (samples x positions) int64 array, which is built once per gene and cached.
+    prepare builds the arrays of many genes at once, as views into a single matrix, and replaces the cache with
+    them; this way a run over many genes only keeps the arrays of the current batch. """
     datalist = []
 
     def __init__(self, datalist):
         self.datalist = datalist
+        self.cache = {}
 
     def __contains__(self, item):
         for l in self.datalist:
@@ -33,26 +148,53 @@ class DataList:
             if gene in self:
                 yield gene
 
+    def prepare(self, genes):
+        """ Builds the count arrays of genes and makes them the new content of the cache. """
+        lengths = [len(self.datalist[0][gene].countArray) for gene in genes]
+        offsets = np.cumsum([0] + lengths)
+        matrix = np.zeros((len(self.datalist), offsets[-1]), np.int64)
+
+        for j, data in enumerate(self.datalist):
+            for gene, offset, length in zip(genes, offsets, lengths):
+                matrix[j, offset:offset + length] = data[gene].countArray
+
+        self.cache = {gene: matrix[:, offset:offset + length] for gene, offset, length in zip(genes, offsets, lengths)}
+
+    def counts(self, gene):
+        """ Returns the (samples x positions) count array of a gene. """
+        if gene not in self.cache:
+            self.cache[gene] = np.array([np.asarray(data[gene].countArray, np.int64) for data in self.datalist])
+        return self.cache[gene]
+
+    def replicates(self):
+        return len(self.datalist) // 2
+
+    def treatedAverage(self, gene):
+        """ Per position average of the treated samples, rounded down. """
+        return np.floor_divide(self.counts(gene)[0::2].sum(axis=0), self.replicates())
+
+    def controlAverage(self, gene):
+        """ Per position average of the control samples, rounded down. """
+        return np.floor_divide(self.counts(gene)[1::2].sum(axis=0), self.replicates())
+
     def treatedCountAverage(self, gene, i):
-        counts = 0
-        for t in range(0, len(self.datalist), 2):
-            counts += int(self.datalist[t][gene].countArray[i])
-        return int(round(counts, 0) / (len(self.datalist) / 2))
+        return int(self.counts(gene)[0::2, i].sum()) // self.replicates()
 
     def controlCountAverage(self, gene, i):
-        counts = 0
-        for c in range(1, len(self.datalist), 2):
-            counts += int(self.datalist[c][gene].countArray[i])
-        return int(round(counts, 0) / (len(self.datalist) / 2))
+        return int(self.counts(gene)[1::2, i].sum()) // self.replicates()
 
 
 class HistoRoutine(StatRoutine):
     settings = None
     fileSearchPath = None
     geneFilter = None
+    histoWorkers = 1
+    force = False
+    pending = None
+    skipped = 0
 
     def get_cli_help(self):
-        return "Creates histogram for every single gene"
+        return get_routine_help("histo")
 
     def get_more_cli_help(self):
         return """Creates a histogram of all genes derives by mod.
@@ -67,7 +209,13 @@ To filter for genes ending with 25S, use:
 $ quralk-pipe histo 25S$
 
 Additionally, free fit strings (without using ^ or $) as well as
-exact strings (starting with ^ and ending with $) can be used as well."""
+exact strings (starting with ^ and ending with $) can be used as well.
+
+Histograms are only drawn again if the counts of the gene or the plot
+settings have changed since they were last drawn. To draw all of them
+anyway, use:
+
+$ quralk-pipe histo --force ^RDN"""
 
     def run(self):
         self.load_settings()
@@ -78,8 +226,15 @@ exact strings (starting with ^ and ending with $) can be used as well."""
         filesearchpath = ModConfiguration("~/QURAlkData/mod_config.ini").get("OutputDirectory")
         self.settings = StatConfiguration("~/QURAlkData/stat_config.ini", filesearchpath)
         self.fileSearchPath = filesearchpath
-        if len(self.arguments) > 0:
-            self.geneFilter = self.arguments[0]
+        self.histoWorkers = self.settings.get("HistoWorkers") or os.cpu_count() or 1
+
+        # The filter is the first argument that is not an option
+        options = [argument for argument in self.arguments if argument.startswith("--")]
+        filters = [argument for argument in self.arguments if not argument.startswith("--")]
+
+        self.force = "--force" in options
+        if len(filters) > 0:
+            self.geneFilter = filters[0]
         else:
             self.geneFilter = ""
 
@@ -87,7 +242,59 @@ exact strings (starting with ^ and ending with $) can be used as well."""
         self.draw_histogram()
 
     def draw_histogram(self):
+        """ Draws a histogram for every gene that matches the filter. With more than one worker, the histograms are
+        drawn by a pool of processes while the averages of the next genes are calculated. Only a bounded number of
+        chunks is handed to the pool at once, so the histograms are not calculated faster than they are drawn.
+
+        Genes whose histogram exists and whose hash in the manifest is unchanged are skipped, unless forced. The
+        manifest is updated for every histogram that has been drawn, even if the run is interrupted. """
+        manifestFile = os.path.join(self.fileSearchPath, HISTO_MANIFEST)
+        manifest = readManifest(manifestFile)
+        self.pending = {}
+        self.skipped = 0
+
+        histograms = self.histograms(manifest)
+
+        def drawn(filename):
+            geneName, digest = self.pending.pop(filename)
+            manifest[geneName] = digest
+            print(filename)
+
+        try:
+            if self.histoWorkers > 1:
+                with multiprocessing.Pool(self.histoWorkers, init_worker) as pool:
+                    chunks = collections.deque()
+
+                    while True:
+                        chunk = list(itertools.islice(histograms, HISTO_CHUNKSIZE))
+                        if chunk:
+                            chunks.append(pool.apply_async(render_histograms, (chunk,)))
+
+                        # Keep every worker busy with up to two chunks and collect them in order
+                        while chunks and (len(chunks) > 2 * self.histoWorkers or not chunk):
+                            for filename in chunks.popleft().get():
+                                drawn(filename)
+
+                        if not chunk:
+                            break
+            else:
+                renderer = HistogramRenderer()
+                try:
+                    for histogram in histograms:
+                        drawn(renderer.render(histogram))
+                finally:
+                    renderer.close()
+        finally:
+            writeManifest(manifestFile, manifest)
+
+        if self.skipped > 0:
+            print("Skipped %i unchanged histograms (use --force to draw them anyway)" % self.skipped)
+
+    def histograms(self, manifest):
+        """ Yields the data of the histogram of every gene that matches the filter and has changed according to
+        manifest, see HistogramRenderer.render. The hashes of the yielded genes are kept in pending. """
         datalist = DataList(self.dataList)
+        settings = plotSettings()
 
         if len(self.geneFilter) == 0:
             filterF = lambda name: True
@@ -101,45 +308,34 @@ exact strings (starting with ^ and ending with $) can be used as well."""
             filterF = lambda name, f=self.geneFilter: str.find(name, f) != -1
 
         # Get all genes common in all files
+        genes = []
         for geneName in datalist.common():
             if not filterF(geneName):
                 continue
             if len(self.geneFilter) > 0:
                 print("Found", self.geneFilter, "in", geneName)
 
-            # Make histogram for all of them!
-            gene = datalist[geneName]
-
-            count_average_treated = []
-            count_average_control = []
-            count_average_difference = []
+            genes.append(geneName)
 
-            for pos in range(gene.length):
-                count_average_treated.append(datalist.treatedCountAverage(geneName, pos))
-                count_average_control.append(datalist.controlCountAverage(geneName, pos))
-                count_average_difference.append(count_average_treated[pos] - count_average_control[pos])
+        # Make histogram for all of them!
+        for i in range(0, len(genes), HISTO_BATCH):
+            datalist.prepare(genes[i:i + HISTO_BATCH])
 
-            f, (ax1, ax2, ax3) = plt.subplots(3, sharex=True, sharey=True)
-            width = 1.0
-            pos = range(gene.Start, gene.Start + gene.length)
+            for geneName in genes[i:i + HISTO_BATCH]:
+                gene = datalist[geneName]
 
-            ax1.bar(pos, count_average_treated, width)
-            ax1.set_xlim(gene.Start, gene.Start + gene.length)
-            ax1.set_xlabel("Position")
-            ax1.set_ylabel("counts")
-            ax1.set_ylim(min(0, min(count_average_difference)),
-                         max(max(max(count_average_treated), max(count_average_control)), 100))
-            ax1.set_title("Gene %s on chromosome %s" % (gene.name, gene.chrms))
+                filename = "histogram_%s.png" % (geneName)
+                filename = os.path.join(*[self.fileSearchPath, filename])
 
-            ax2.bar(pos, count_average_control, width)
-            ax3.bar(pos, count_average_difference, width)
+                digest = histogramHash(datalist.counts(geneName), [gene.name, gene.chrms, gene.Start], settings)
+                if not self.force and manifest.get(geneName) == digest and os.path.exists(filename):
+                    self.skipped += 1
+                    continue
+                self.pending[filename] = (geneName, digest)
 
-            f.subplots_adjust(hspace=0)
-            plt.setp([a.get_xticklabels() for a in f.axes[:-1]], visible=False)
-
-            filename = "histogram_%s.png" % (geneName)
-            filename = os.path.join(*[self.fileSearchPath, filename])
-
-            print(filename)
-            plt.savefig(filename)
+                count_average_treated = datalist.treatedAverage(geneName)
+                count_average_control = datalist.controlAverage(geneName)
+                count_average_difference = count_average_treated - count_average_control
 
+                yield (gene.name, gene.chrms, gene.Start, gene.length, count_average_treated, count_average_control,
+                       count_average_difference, filename)
@@ -1,11 +1,19 @@
 import colorama
 import os
 import queue
+import shutil
+import socket
 import subprocess
 import threading
+import time
 
+from lib.Compression import Compressor
 from lib.configuration.ModConfiguration import ModConfiguration
+from lib.Lease import LeaseDirectory
+from lib.Metrics import Metrics
+from lib.Routines import get_routine_help
 from lib.Sample import Sample
+from lib.Scheduler import StageScheduler, Task
 
 from .BaseRoutine import BaseRoutine
 
@@ -52,21 +60,83 @@ def check_samtools():
         raise ToolNotFoundException
 
 
+# Directory in OutputDirectory holding the leases and markers of distributed runs
+LEASE_DIRECTORY = ".leases"
+
 
 class ModRoutine(BaseRoutine):
     settings = None
     samples = []
     queue = None
+    forceFrom = None
+    compressor = None
+    metrics = None
+    clearLeases = False
+    rawFiles = {}
 
     def get_cli_help(self):
-        return "Aligns fastq data to a genom and counts modifications"
+        return get_routine_help("mod")
+
+    def get_more_cli_help(self):
+        return """Aligns the fastq data of every sample in the input directory to a genom and
+counts modifications.
+
+Stages of a sample whose outputs are newer than their inputs and whose
+configuration has not changed are skipped. To run a stage and all following
+stages again, use:
+
+$ quralk-pipe mod --force-from intersect
+
+Stages are cutadapters, bowtieAlign, fivePrimeFix, samToBam, sortBam,
+intersect and modcount (bowtieAlignFix replaces bowtieAlign, fivePrimeFix
+and samToBam if StreamFivePrimeFix is set; trimAlign replaces cutadapters
+and bowtieAlign, or cutadapters and bowtieAlignFix, if StreamTrimAlign is set;
+the native CountEngine has no sortBam and intersect).
+
+If Distributed is set, several hosts can work on the same input and output
+directories at once: every host claims whole samples through lease files in
+the .leases directory of the output directory, and runs them on its own
+MaxPythonThreads workers. Samples of a crashed host are taken over once their
+lease has not been renewed for LeaseTimeout seconds. Finished samples are
+skipped until their input file changes; to run them again, use:
+
+$ quralk-pipe mod --clear-leases
+
+while no other host is running."""
 
     def run(self):
         """ Main loop to run modroutine. """
+        self.parse_arguments()
         self.load_settings()
+        self.check_arguments()
         self.check_environment()
-        self.prepare_input_files()
-        self.run_samples()
+
+        self.compressor = Compressor(self.settings.get("CompressionThreads"))
+        self.metrics = Metrics()
+        try:
+            self.prepare_input_files()
+            self.run_samples()
+        finally:
+            self.compressor.shutdown()
+            self.report_metrics()
+
+    def parse_arguments(self):
+        """ Reads the command line options. """
+        self.forceFrom = None
+        self.clearLeases = "--clear-leases" in self.arguments
+
+        if "--force-from" in self.arguments:
+            i = self.arguments.index("--force-from")
+            if i + 1 >= len(self.arguments):
+                raise Exception("--force-from needs the name of a stage")
+            self.forceFrom = self.arguments[i + 1]
+
+    def check_arguments(self):
+        """ Makes sure that the options are valid for the current configuration. """
+        if self.forceFrom is not None:
+            stages = [stage.name for stage in Sample("", self.settings).getStages()]
+            if self.forceFrom not in stages:
+                raise Exception("Unknown stage %s, stages are: %s" % (self.forceFrom, ", ".join(stages)))
 
     def load_settings(self):
         """ Loads configuration """
@@ -84,6 +154,10 @@ class ModRoutine(BaseRoutine):
             ("samtools", check_samtools)
         ]
 
+        # The native counting engine does not need intersectBed
+        if self.settings.get("CountEngine") == "native":
+            tocheck.remove(("bedtools", check_bedtools))
+
         tool_missing = False
 
         for tool in tocheck:
@@ -103,6 +177,7 @@ class ModRoutine(BaseRoutine):
         compressed."""
         files = []
         samples = []
+        self.rawFiles = {}
         input_directory = self.settings.get("InputDirectory")
 
         for filename in os.listdir(input_directory):
@@ -119,19 +194,22 @@ class ModRoutine(BaseRoutine):
 
             if filename.endswith(".fastq"):
                 # non-gzip files must be packed first
-                target_file = os.path.join(*[input_directory, filename])
-                try:
-                    subprocess.check_output("gzip -f " + target_file, shell=True)
-                except:
-                    print("[Error] It was not possible to pack " + filename)
-                    raise Exception("Aborted")
-
                 samples.append(sample_name)
                 files.append(os.path.join(*[input_directory, filename + ".gz"]))
+
+                if self.settings.get("Distributed"):
+                    # Only the host claiming the sample may pack it
+                    self.rawFiles[sample_name] = os.path.join(*[input_directory, filename])
+                else:
+                    self.compressor.submit(os.path.join(*[input_directory, filename]))
             elif filename.endswith(".fastq.gz"):
                 samples.append(sample_name)
                 files.append(os.path.join(*[input_directory, filename]))
 
+        for filename, e in self.compressor.wait():
+            print("[Error] It was not possible to pack " + os.path.basename(filename) + ": " + str(e))
+            raise Exception("Aborted")
+
         self.samples = samples
 
     def run_samples(self):
@@ -151,6 +229,14 @@ class ModRoutine(BaseRoutine):
 
         print("")
 
+        if self.settings.get("Distributed"):
+            self.run_distributed()
+            return
+
+        if self.settings.get("Scheduler") == "stage":
+            self.run_stage_scheduler()
+            return
+
         # Now split the task into smaller ones for parallelization
         try:
             # Boot threads
@@ -165,18 +251,150 @@ class ModRoutine(BaseRoutine):
 
             # Blocks until all tasks are done
             self.queue.join()
+            self.wait_for_compression()
 
             # Report success
             print("\nTasks are done.")
         except Exception as e:
             raise Exception("Unknown exception raised: " + str(e))
 
+    def wait_for_compression(self):
+        """ Waits until the intermediate files have been compressed in the background. """
+        for filename, e in self.compressor.wait():
+            print("[Error] It was not possible to pack %s: %s" % (os.path.basename(filename), e))
+
+    def report_metrics(self):
+        """ Writes the performance metrics of all stages next to the outputs and prints a summary. """
+        # Hosts of a distributed run share the output directory
+        name = "mod_%s_%i" % (socket.gethostname(), os.getpid()) if self.settings.get("Distributed") else "mod"
+        filenames = self.metrics.write(self.settings.get("OutputDirectory"), name)
+        self.metrics.printSummary()
+        print("Metrics have been written to %s" % (filenames[1],))
+
     def run_threads(self):
         """ Gets called by threads. Fetches a sample, runs the calculation processes and reports
         to the queue that it's done. """
         while True:
             samplename = self.queue.get()
-            sample = Sample(samplename, self.settings)
+            sample = Sample(samplename, self.settings, self.forceFrom, self.compressor, self.metrics)
             sample.run()
 
             self.queue.task_done()
+
+    def run_stage_scheduler(self):
+        """ Runs every (sample, stage) pair as a task of its own. Stages of different samples overlap, while the
+        number of concurrent bowtie and I/O stages is limited separately. """
+        limits = {
+            "align": self.settings.get("MaxAlignJobs"),
+            "io": self.settings.get("MaxIOJobs") or None,
+        }
+        scheduler = StageScheduler(self.settings.get("MaxPythonThreads"), limits)
+
+        for samplename in self.samples:
+            sample = Sample(samplename, self.settings, self.forceFrom, self.compressor, self.metrics)
+            stages, state = sample.prepareStages()
+
+            tasks = []
+            for stage in stages:
+                function = lambda sample=sample, stage=stage, state=state: sample.runStage(stage, state)
+                tasks.append(Task(samplename, stage.name, stage.resource, function))
+
+            scheduler.add_chain(tasks)
+
+        def report(chain):
+            if all(task.status == Task.DONE for task in chain) and len(chain) > 0:
+                print("Completed sample %s" % (chain[0].sampleName,))
+
+        failed = scheduler.run(report)
+        self.wait_for_compression()
+
+        if len(failed) > 0:
+            print("\nTasks are done, %i failed:" % len(failed))
+            for task in failed:
+                print(" • {} [{}{}{}]".format(task.sampleName, colorama.Fore.RED, task.stageName, colorama.Fore.RESET))
+        else:
+            print("\nTasks are done.")
+
+    def run_distributed(self):
+        """ Runs the samples that this host manages to claim, until every sample has been finished by some host. """
+        directory = os.path.join(self.settings.get("OutputDirectory"), LEASE_DIRECTORY)
+
+        if self.clearLeases and os.path.exists(directory):
+            print("Clearing leases and markers of earlier runs")
+            shutil.rmtree(directory)
+
+        leases = LeaseDirectory(directory, self.settings.get("LeaseTimeout"))
+        results = {}
+
+        try:
+            threads = [threading.Thread(target=self.run_distributed_worker, args=(leases, results))
+                       for i in range(0, self.settings.get("MaxPythonThreads"))]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            leases.close()
+
+        self.wait_for_compression()
+
+        failed = [sample for sample in results if not results[sample]]
+        print("\nTasks are done, this host has run %i samples, %i failed." % (len(results), len(failed)))
+        for sample in failed:
+            print(" • {} [{}failed{}]".format(sample, colorama.Fore.RED, colorama.Fore.RESET))
+
+    def run_distributed_worker(self, leases, results):
+        """ Claims and runs free samples. Waits while samples are leased by other hosts, as their leases may still
+        turn stale; samples run by the other workers of this host are left to them. """
+        while True:
+            pending = False
+
+            for sampleName in self.samples:
+                stamp = self.input_stamp(sampleName)
+                status = leases.status(sampleName, stamp)
+
+                if status in ("done", "failed"):
+                    continue
+
+                if status == "leased" and leases.holds(sampleName):
+                    continue
+
+                pending = True
+
+                if status is None and leases.claim(sampleName, stamp):
+                    results[sampleName] = self.run_claimed_sample(sampleName)
+                    leases.release(sampleName, stamp, results[sampleName])
+                    break
+            else:
+                if not pending:
+                    return
+
+                time.sleep(leases.timeout / 5)
+
+    def input_stamp(self, sampleName):
+        """ Identifies the input of a sample by its modification time in nanoseconds. Packing keeps the modification
+        time, so the stamp does not change when the claiming host compresses a .fastq file; the size does change, and
+        is therefore not part of the stamp. """
+        input_directory = self.settings.get("InputDirectory")
+
+        for extension in (".fastq.gz", ".fastq"):
+            filename = os.path.join(input_directory, sampleName + extension)
+            try:
+                return os.stat(filename).st_mtime_ns
+            except FileNotFoundError:
+                pass
+
+        return None
+
+    def run_claimed_sample(self, sampleName):
+        """ Packs the raw input of a claimed sample if needed and runs it. Returns True if it has been completed. """
+        try:
+            if sampleName in self.rawFiles and os.path.exists(self.rawFiles[sampleName]):
+                self.compressor.compress(self.rawFiles[sampleName])
+
+            sample = Sample(sampleName, self.settings, self.forceFrom, self.compressor, self.metrics)
+            return sample.run()
+        except Exception as e:
+            print("[Error] Sample %s failed: %s" % (sampleName, e))
+            return False
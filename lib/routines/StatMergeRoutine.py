@@ -0,0 +1,86 @@
+import contextlib
+import csv
+import datetime
+import heapq
+import os
+
+from lib import StatShard
+from lib.configuration.ModConfiguration import ModConfiguration
+from lib.Routines import get_routine_help
+
+from .BaseRoutine import BaseRoutine
+
+
+class StatMergeRoutine(BaseRoutine):
+    def get_cli_help(self):
+        return get_routine_help("stat-merge")
+
+    def get_more_cli_help(self):
+        return """Merges the partial files written by stat --shard i/N into an output_stats_*.csv
+file, the same as a stat run without shards would have written.
+
+$ quralk-pipe stat-merge [partial files]
+
+Without arguments, all partial files in the output directory are merged. All N
+shards must be present and must have been run on the same input files with the
+same configuration."""
+
+    def run(self):
+        directory = ModConfiguration("~/QURAlkData/mod_config.ini").get("OutputDirectory")
+        partials = self.arguments if len(self.arguments) > 0 else StatShard.findPartials(directory)
+
+        if len(partials) == 0:
+            raise Exception("No partial stat files found in " + directory)
+
+        outputFile = os.path.join(*[
+            directory,
+            "output_stats_{}.csv".format(datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S.txt"))
+        ])
+
+        rows = self.merge(partials, outputFile)
+
+        print("Merged %i shards (%i rows) into %s" % (len(partials), rows, outputFile))
+
+    def merge(self, partials, outputFile):
+        """ Checks that partials are the complete set of shards of one run and writes their rows in the original
+        gene order. Returns the number of rows written. """
+        with contextlib.ExitStack() as stack:
+            handles = [stack.enter_context(open(partial, "r", newline="")) for partial in partials]
+            metadata = [StatShard.readMetadata(fh) for fh in handles]
+            readers = [csv.reader(fh, delimiter="\t") for fh in handles]
+            headers = [next(reader) for reader in readers]
+
+            self.check(partials, metadata, headers)
+
+            with open(outputFile, "w") as fh:
+                writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
+                writer.writerow(headers[0][1:])
+
+                # Every partial file is already in gene order, and every gene is in exactly one of them
+                rows = 0
+                for row in heapq.merge(*readers, key=lambda row: int(row[0])):
+                    writer.writerow(row[1:])
+                    rows += 1
+
+        return rows
+
+    def check(self, partials, metadata, headers):
+        count = metadata[0]["shards"]
+        fingerprint = metadata[0]["fingerprint"]
+
+        for partial, meta, header in zip(partials, metadata, headers):
+            if meta["shards"] != count:
+                raise Exception("%s is shard %i of %i, expected a shard of %i" % (
+                    partial, meta["shard"], meta["shards"], count))
+            if meta["fingerprint"] != fingerprint:
+                raise Exception("%s has been run on different input files or with a different configuration than %s"
+                                % (partial, partials[0]))
+            if header != headers[0]:
+                raise Exception("%s has a different header than %s" % (partial, partials[0]))
+
+        shards = sorted(meta["shard"] for meta in metadata)
+        if shards != list(range(1, count + 1)):
+            missing = sorted(set(range(1, count + 1)) - set(shards))
+            duplicates = sorted(set(shard for shard in shards if shards.count(shard) > 1))
+            raise Exception("Expected every shard of %i exactly once; missing: %s, duplicated: %s" % (
+                count, missing or "none", duplicates or "none"))
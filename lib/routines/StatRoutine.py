@@ -1,15 +1,64 @@
+import concurrent.futures
 import csv
 import datetime
 import os
 
+import numpy as np
+
+from lib import CountModStore, StatShard
 from lib.configuration.StatConfiguration import StatConfiguration
 from lib.configuration.ModConfiguration import ModConfiguration
-from lib.GeneModCount import GeneModCount2 as GeneModCount
-from lib.StatMagician import StatMagician
+from lib.GeneModCount import COUNT_DTYPE, GeneModCount2 as GeneModCount
+from lib.Metrics import Metrics
+from lib.Routines import get_routine_help
+from lib.StatMagician import StatMagician, TableCache
+from lib.StatPool import StatPool
 
 from .BaseRoutine import BaseRoutine
 
 
+def readGenes(reader, keys):
+    """ Reads the genes given by keys from a CountMod reader, keeping the order of keys. """
+    data = {key: None for key in keys}
+
+    for key, description, counts in reader.read(keys):
+        gene = GeneModCount.restore_from_storage(*description)
+        gene.countArray = counts
+        data[key] = gene
+
+    return data
+
+
+def readPacked(reader, keys):
+    """ Reads the genes given by keys in a worker process. Returns their descriptions and counts packed into a single
+    array, which is much cheaper to send back than one gene object per gene. """
+    descriptions = {}
+    counts = {}
+
+    for key, description, geneCounts in reader.read(keys):
+        descriptions[key] = description
+        counts[key] = geneCounts
+
+    lengths = [len(counts[key]) for key in keys]
+    packed = np.concatenate([counts[key] for key in keys]) if len(keys) > 0 else np.zeros(0)
+
+    return [descriptions[key] for key in keys], lengths, packed.astype(COUNT_DTYPE, copy=False)
+
+
+def unpackGenes(keys, descriptions, lengths, packed):
+    """ Restores the genes read by readPacked, their counts being views into the packed array. """
+    data = {}
+    offset = 0
+
+    for key, description, length in zip(keys, descriptions, lengths):
+        gene = GeneModCount.restore_from_storage(*description)
+        gene.countArray = packed[offset:offset + length]
+        data[key] = gene
+        offset += length
+
+    return data
+
+
 class StatRoutine(BaseRoutine):
     settings = None
     dataList = []
@@ -19,19 +68,53 @@ class StatRoutine(BaseRoutine):
     OddsRatioThreshold = 1.5
     TAIL = 45
     outputFile = None
+    metrics = None
+    shard = None
+    fingerprint = None
+    geneOrdinals = None
 
     def get_cli_help(self):
-        return "Runs statistical tests over the data created with mod and saves only significant gene positions"
+        return get_routine_help("stat")
 
     def get_more_cli_help(self):
         return """Runs statistical tests over the data created with the mod procedure and only
-saves gene positions with significant changes between treated and control sample."""
+saves gene positions with significant changes between treated and control sample.
+
+$ quralk-pipe stat --shard 2/8
+
+only tests the genes of shard 2 out of 8 and writes them to a partial file in the
+output directory. Once all shards have been run, stat-merge combines them."""
 
     def run(self):
+        self.metrics = Metrics()
         self.load_settings()
-        self.load_data()
+
+        inputs = [filename for pair in self.settings.get("files") for filename in pair]
+        with self.metrics.measure("stat", "load", inputs):
+            self.load_data()
+
+        if self.shard is not None:
+            with self.metrics.measure("stat", "fingerprint", inputs):
+                self.fingerprint = StatShard.fingerprint(self.settings, self.TAIL)
+
         self.run_statistics()
 
+        if self.shard is not None:
+            # The partial file only appears once it is complete
+            partial = StatShard.partialFilename(os.path.dirname(self.outputFile), *self.shard)
+            os.replace(self.outputFile, partial)
+            print("Shard %i of %i has been written to %s" % (self.shard + (partial,)))
+
+        self.report_metrics()
+
+    def report_metrics(self):
+        """ Writes the performance metrics of the load, test and write phases and prints a summary. """
+        # Shards may run at the same time in the same output directory
+        name = "stat_shard-%i-of-%i" % self.shard if self.shard is not None else "stat"
+        filenames = self.metrics.write(os.path.dirname(self.outputFile), name)
+        self.metrics.printSummary()
+        print("Metrics have been written to %s" % (filenames[1],))
+
     def load_settings(self):
         filesearchpath = ModConfiguration("~/QURAlkData/mod_config.ini").get("OutputDirectory")
         self.settings = StatConfiguration("~/QURAlkData/stat_config.ini", filesearchpath)
@@ -43,43 +126,131 @@ saves gene positions with significant changes between treated and control sample
             "output_stats_{}.csv".format(datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S.txt"))
         ])
 
+        for i, argument in enumerate(self.arguments):
+            if argument.startswith("--shard="):
+                self.shard = StatShard.parseShard(argument[len("--shard="):])
+            elif argument == "--shard" and i + 1 < len(self.arguments):
+                self.shard = StatShard.parseShard(self.arguments[i + 1])
+
+        if self.shard is not None:
+            self.outputFile = StatShard.partialFilename(filesearchpath, *self.shard) + ".tmp"
+
     def load_data(self):
+        """ Loads the treated and control files in parallel. A first pass only reads the gene descriptions of every
+        file; counts are then read only for the genes that are present in all files.
+
+        Parsing text files holds the GIL, so they are loaded by a pool of processes. Binary files are loaded by
+        threads, which keeps their counts zero-copy views into the memory-mapped files. """
         print("Loading data files")
 
-        for i in range(0, len(self.settings.get("files"))):
-            # Treated: even
-            self.dataList.append(self.readSingleDataFile(self.settings.get("files")[i][0]))
-            self.dataFileList.append(self.settings.get("files")[i][0])
-            # Control: uneven
-            self.dataList.append(self.readSingleDataFile(self.settings.get("files")[i][1]))
-            self.dataFileList.append(self.settings.get("files")[i][1])
+        files = []
+        for treated, control in self.settings.get("files"):
+            # Treated: even, Control: uneven
+            files.append(treated)
+            files.append(control)
+
+        workers = self.settings.get("LoadWorkers") or min(len(files), os.cpu_count() or 1)
+
+        if workers > 1 and not all(CountModStore.isBinary(filename) for filename in files):
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+        with executor as pool:
+            readers = list(pool.map(CountModStore.openReader, files))
+
+            # Genes present in every file, in the order of the first one
+            common = [key for key in readers[0].keys() if all(key in reader.genes for reader in readers[1:])]
+
+            for filename, reader in zip(files, readers):
+                print(" - Load: %s (found %i genes)" % (os.path.basename(filename), len(reader.genes)))
+            print("    (%i genes are common to all files)" % len(common))
+
+            self.geneOrdinals = {key: i for i, key in enumerate(common)}
+            if self.shard is not None:
+                common = [key for key in common if StatShard.inShard(key, *self.shard)]
+                print("    (%i genes are in shard %i of %i)" % ((len(common),) + self.shard))
+
+            if isinstance(pool, concurrent.futures.ProcessPoolExecutor):
+                self.dataList = [unpackGenes(common, *packed)
+                                 for packed in pool.map(readPacked, readers, [common] * len(readers))]
+            else:
+                self.dataList = list(pool.map(readGenes, readers, [common] * len(readers)))
+            self.dataFileList = files
 
         print("Loading has been completed")
 
     def run_statistics(self):
-        magic = StatMagician(self.dataList, self.settings.get("FDR"), self.settings.get("OddsRatioThreshold"))
-        statistics = magic.run()
+        cacheSize = self.settings.get("TestCacheSize")
+        minTotalStops = self.settings.get("MinTotalStops")
+        minGeneCount = self.settings.get("MinGeneCount")
+
+        if self.settings.get("StatWorkers") > 1:
+            magic = StatPool(
+                self.dataList,
+                self.settings.get("FDR"),
+                self.settings.get("OddsRatioThreshold"),
+                self.settings.get("TestEngine"),
+                self.settings.get("PAdjustMethod"),
+                self.settings.get("StatWorkers"),
+                cacheSize,
+                minTotalStops,
+                minGeneCount
+            )
+        else:
+            magic = StatMagician(
+                self.dataList,
+                self.settings.get("FDR"),
+                self.settings.get("OddsRatioThreshold"),
+                self.settings.get("TestEngine"),
+                self.settings.get("PAdjustMethod"),
+                TableCache(cacheSize) if cacheSize > 0 else None,
+                minTotalStops,
+                minGeneCount
+            )
 
-        self.writeData(statistics)
+        if self.settings.get("StreamResults"):
+            # Genes are written while the next ones are tested, so both phases are measured together
+            with self.metrics.measure("stat", "testWrite", outputs=[self.outputFile]):
+                self.writeStream(magic.runIter())
+        else:
+            with self.metrics.measure("stat", "test"):
+                statistics = magic.run()
+
+            with self.metrics.measure("stat", "write", outputs=[self.outputFile]):
+                self.writeData(statistics)
+
+        if minTotalStops > 0 or minGeneCount > 0:
+            print("Prefilter: %i of %i positions tested, %i skipped (%i genes below MinGeneCount)" % (
+                magic.testedPositions, magic.testedPositions + magic.skippedPositions, magic.skippedPositions,
+                magic.skippedGenes))
+
+        # The vectorized engine tests whole genes and does not use the cache
+        if magic.cache is not None and magic.cache.hits + magic.cache.misses > 0:
+            print("Test cache: %i of %i tables were cached (hit rate %.1f%%)" % (
+                magic.cache.hits, magic.cache.hits + magic.cache.misses, 100 * magic.cache.hitRate()))
 
     def readSingleDataFile(self, filename):
         print(" - Load: %s" % os.path.basename(filename))
 
         data = {}
-        lastDataIndex = None
 
-        with open(filename, "r") as fh:
-            for line in fh:
-                # Skip non-description lines
-                if not line.startswith(">"):
-                    continue
+        if CountModStore.isBinary(filename):
+            genes = CountModStore.BinaryReader(filename)
+        else:
+            genes = CountModStore.readText(filename)
 
-                gene = GeneModCount.restore_from_storage(*line.split()[1:11])
-                gene.countArray = [int(x) for x in next(fh).split()]
-                gene_index = gene.name + "_" + str(gene.Start) + "_" + str(gene.End)
+        for description, counts in genes:
+            gene = GeneModCount.restore_from_storage(*description)
+            if isinstance(counts, str):
+                gene.countArray = CountModStore.parseCounts(counts, description, filename)
+            else:
+                # Zero-copy view into the binary file
+                gene.countArray = counts
+            gene_index = gene.name + "_" + str(gene.Start) + "_" + str(gene.End)
 
-                #data[gene.name] = gene
-                data[gene_index] = gene
+            #data[gene.name] = gene
+            data[gene_index] = gene
 
         print("    (found %i genes)" % len(data))
 
@@ -90,58 +261,83 @@ saves gene positions with significant changes between treated and control sample
 
         with open(self.outputFile, "w") as fh:
             writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
-            fileheader = []
-
-            for i in range(0, len(self.dataFileList)):
-                fileheader.append(os.path.basename(self.dataFileList[i]))
-                fileheader.append(os.path.basename(self.dataFileList[i]) + "_SUM")
-
-            header = [
-                 "geneName",
-                 "chrom",
-                 "strand",
-                 "type",
-                 "start",
-                 "end",
-                 "length",
-                 "pos_o_gene",
-                 "chisq",
-                 "p_origin",
-                 "p_adjusted",
-                 "odds_ratio",
-                 "OR_lower",
-                 "OR_upper"
-             ] + fileheader
 
             # Write header line
-            writer.writerow(header)
+            self.writeHeader(fh, writer)
 
             for gene in output:
-                #print("For gene...", gene.name)
-                for i in range(0, max(output[gene].length - self.TAIL, 0)):
-                    p_adjusted = output[gene].testArray[i][2]
-                    OR = output[gene].testArray[i][3]
-
-                    if p_adjusted != "NA" and p_adjusted <= self.FDR and OR > self.OddsRatioThreshold:
-                        # reformat chi, p_origin, p_adjusted, OR, OR_L and OR_U
-                        values = output[gene].testArray[i]
-
-                        chi = '{:.3f}'.format(values[0])
-                        p_origin = '{:.4g}'.format(values[1])
-                        p_adjusted = '{:.4g}'.format(values[2])
-                        OR = '{:.3f}'.format(values[3])
-                        OR_l = '{:.3f}'.format(values[4])
-                        OR_u = '{:.3f}'.format(values[5])
-
-                        row = output[gene].description[:7] + [i + 1] + [chi, p_origin, p_adjusted, OR, OR_l, OR_u] + \
-                              output[gene].testArray[i][6:]
-                        writer.writerow(row)
-                    """else:
-                        print(
-                            output[gene].name,
-                            "Pos",
-                            i + 1,
-                            p_adjusted,
-                            "NA" if p_adjusted == "NA" else p_adjusted <= self.FDR,
-                            "NA" if p_adjusted == "NA" else int(p_adjusted) > self.OddsRatioThreshold
-                        )"""
+                self.writeGene(writer, output[gene], self.rowPrefix(gene))
+
+    def writeStream(self, genes):
+        """ Writes the genes of an iterator of (gene name, gene) as they come and releases their test arrays right
+        after, so only one gene's results are held at a time. """
+        print(self.outputFile)
+
+        with open(self.outputFile, "w") as fh:
+            writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
+            self.writeHeader(fh, writer)
+
+            for name, gene in genes:
+                self.writeGene(writer, gene, self.rowPrefix(name))
+                gene.testArray = None
+
+    def writeHeader(self, fh, writer):
+        """ Writes the header line. Partial files of a shard start with their metadata and an ordinal column. """
+        if self.shard is None:
+            writer.writerow(self.header())
+        else:
+            StatShard.writeMetadata(fh, self.shard[0], self.shard[1], self.fingerprint)
+            writer.writerow([StatShard.ORDINAL_COLUMN] + self.header())
+
+    def rowPrefix(self, key):
+        """ Columns put in front of every row of a gene; the ordinal of the gene if a shard is written. """
+        return [] if self.shard is None else [self.geneOrdinals[key]]
+
+    def header(self):
+        fileheader = []
+
+        for i in range(0, len(self.dataFileList)):
+            fileheader.append(os.path.basename(self.dataFileList[i]))
+            fileheader.append(os.path.basename(self.dataFileList[i]) + "_SUM")
+
+        return [
+             "geneName",
+             "chrom",
+             "strand",
+             "type",
+             "start",
+             "end",
+             "length",
+             "pos_o_gene",
+             "chisq",
+             "p_origin",
+             "p_adjusted",
+             "odds_ratio",
+             "OR_lower",
+             "OR_upper"
+         ] + fileheader
+
+    def writeGene(self, writer, gene, prefix=()):
+        """ Writes the positions of a gene passing FDR and OddsRatioThreshold, leaving out the TAIL. """
+        for i in range(0, max(gene.length - self.TAIL, 0)):
+            if gene.testArray[i] == "NA":
+                # Not tested
+                continue
+
+            p_adjusted = gene.testArray[i][2]
+            OR = gene.testArray[i][3]
+
+            if p_adjusted != "NA" and p_adjusted <= self.FDR and OR > self.OddsRatioThreshold:
+                # reformat chi, p_origin, p_adjusted, OR, OR_L and OR_U
+                values = gene.testArray[i]
+
+                chi = '{:.3f}'.format(values[0])
+                p_origin = '{:.4g}'.format(values[1])
+                p_adjusted = '{:.4g}'.format(values[2])
+                OR = '{:.3f}'.format(values[3])
+                OR_l = '{:.3f}'.format(values[4])
+                OR_u = '{:.3f}'.format(values[5])
+
+                row = list(prefix) + gene.description[:7] + [i + 1] + [chi, p_origin, p_adjusted, OR, OR_l, OR_u] + \
+                      gene.testArray[i][6:]
+                writer.writerow(row)
@@ -0,0 +1,8 @@
+""" Makes the lib package and the synthetic data generator of the benchmarks importable from the tests. """
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
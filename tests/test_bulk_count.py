@@ -0,0 +1,46 @@
+""" The bulk parser must count the same ModStops, in the same gene order, as the line by line parser. """
+import os
+
+import pytest
+
+import synthetic
+import lib.Sample
+from lib.Sample import Sample
+
+
+def writeIntersect(filename, genes, annotationType):
+    """ An Intersect .tab file with reads inside of the genes, reads on both gene ends and two genes that only differ
+    by name. """
+    reads = synthetic.make_reads(genes, 2000)
+    for gene in genes:
+        for shift in range(-2, 3):
+            reads.append(synthetic.Read("s%i" % len(reads), gene.chrom, gene.strand, gene.start + shift, 30, 0))
+            reads.append(synthetic.Read("e%i" % len(reads), gene.chrom, gene.strand, gene.end - 29 + shift, 30, 0))
+    synthetic.write_intersect(filename, genes, reads, annotationType)
+
+    gene = genes[0]
+    start = gene.start if annotationType == "gff" else gene.start - 1
+    with open(filename, "a") as fh:
+        for name in ("TWIN1", "TWIN2", "TWIN1"):
+            fh.write("%s\t%i\t%i\tr\t%s\tgene\t%i\t%i\t%s\n" % (
+                gene.chrom, gene.start + 5, gene.start + 40, gene.strand, start, gene.end, name))
+
+
+@pytest.mark.parametrize("annotationType", ["gff", "bed"])
+@pytest.mark.parametrize("chunk", [997, 1 << 20])
+def test_bulk_matches_lines(tmp_path, monkeypatch, annotationType, chunk):
+    # Small chunks split lines between two reads of the file
+    monkeypatch.setattr(lib.Sample, "BULK_COUNT_CHUNK", chunk)
+
+    filename = os.path.join(str(tmp_path), "Intersect.tab")
+    writeIntersect(filename, synthetic.make_genes(15), annotationType)
+
+    sample = Sample("sample", synthetic.Settings())
+    lines = sample.countIntersect(filename, annotationType)
+    bulk = sample.countIntersectBulk(filename, annotationType)
+
+    assert len(lines) > 0
+    assert list(bulk) == list(lines)
+    for key in lines:
+        assert bulk[key].description == lines[key].description
+        assert list(bulk[key].countArray) == list(lines[key].countArray)
@@ -0,0 +1,52 @@
+""" Text and binary CountMod files must hold the same genes, and converting between them must not change them. """
+import os
+
+import pytest
+
+import synthetic
+from lib import CountModStore
+
+
+def readAll(filename):
+    reader = CountModStore.openReader(filename)
+    return [(key, [str(x) for x in description], counts.tolist())
+            for key, description, counts in reader.read(list(reader.keys()))]
+
+
+@pytest.fixture
+def textFile(tmp_path):
+    filename = os.path.join(str(tmp_path), "CountMod-syn_sample.tab")
+    genes = synthetic.make_genes(25, minLength=1, maxLength=400)
+    synthetic.write_countmod(filename, genes, signal=synthetic.make_signal(genes))
+    return filename
+
+
+def test_round_trip(textFile):
+    binary = os.path.splitext(textFile)[0] + ".cmb"
+    text = os.path.splitext(textFile)[0] + "-back.tab"
+
+    assert CountModStore.convert(textFile, binary) == 25
+    assert CountModStore.convert(binary, text) == 25
+
+    assert readAll(binary) == readAll(textFile)
+    with open(textFile, "rb") as fh, open(text, "rb") as fhBack:
+        assert fhBack.read() == fh.read()
+
+
+def test_text_index_matches_scan(textFile):
+    indexed = CountModStore.TextReader(textFile)
+    os.remove(textFile + CountModStore.TEXT_INDEX_EXTENSION)
+    scanned = CountModStore.TextReader(textFile)
+
+    assert indexed.genes == scanned.genes
+    assert indexed.offsets == scanned.offsets
+
+
+def test_truncated_text_file_fails(textFile):
+    with open(textFile, "rb") as fh:
+        data = fh.read()
+    with open(textFile, "wb") as fh:
+        fh.write(data[:-50])
+
+    with pytest.raises(Exception, match="expected"):
+        readAll(textFile)
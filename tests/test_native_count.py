@@ -0,0 +1,71 @@
+""" The native count engine must count the same ModStops per gene as intersectBed followed by runModCount. """
+import os
+
+import numpy as np
+import pytest
+
+import synthetic
+from lib import CountModStore
+from lib.Sample import Sample
+
+FAKEBIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks", "fakebin")
+
+
+def makeReads(genes, seed=0):
+    """ Reads inside of the genes, plus reads around both ends of every gene and reads on the other strand. """
+    reads = synthetic.make_reads(genes, 3000, seed)
+
+    for gene in genes:
+        other = "-" if gene.strand == "+" else "+"
+        for shift in range(-3, 4):
+            reads.append(synthetic.Read("s%s" % len(reads), gene.chrom, gene.strand, gene.start + shift, 30, 0))
+            reads.append(synthetic.Read("e%s" % len(reads), gene.chrom, gene.strand, gene.end - 30 + shift, 30, 0))
+        reads.append(synthetic.Read("o%s" % len(reads), gene.chrom, other, gene.start + 20, 30, 0))
+
+    return reads
+
+
+def readCounts(filename):
+    return {key: (description, counts.tolist()) for key, description, counts in
+            CountModStore.openReader(filename).read(CountModStore.openReader(filename).keys())}
+
+
+@pytest.mark.parametrize("annotationType", ["gff", "bed"])
+def test_native_matches_intersect(tmp_path, monkeypatch, annotationType):
+    monkeypatch.setenv("PATH", FAKEBIN + os.pathsep + os.environ["PATH"])
+    directory = str(tmp_path)
+
+    genes = synthetic.make_genes(12)
+    # A gene overlapping another one on the same strand
+    genes.append(synthetic.Gene("OVERLAP", genes[0].chrom, genes[0].strand, genes[0].start + 10, genes[0].start + 250))
+
+    annotation = os.path.join(directory, "annotation." + annotationType)
+    if annotationType == "gff":
+        synthetic.write_gff(annotation, genes)
+    else:
+        synthetic.write_bed(annotation, genes)
+
+    settings = synthetic.Settings(
+        InputDirectory=directory,
+        OutputDirectory=directory,
+        ReferenceGenomFile="syn",
+        GeneAnnotationFile=annotation,
+        ModCountParser="line",
+        CountModFormat="text",
+    )
+    sample = Sample("sample", settings)
+
+    # The stand-in samtools and intersectBed read "BAM" files as SAM text
+    synthetic.write_sam(sample.getFileName("Sorted", ".bam", True), genes, makeReads(genes))
+    synthetic.write_sam(sample.getFileName("5pFixed", ".bam", True), genes, makeReads(genes))
+
+    sample.runIntersect()
+    sample.runModCount()
+    intersect = readCounts(sample.getCountModFileName())
+
+    sample.runNativeModCount()
+    native = readCounts(sample.getCountModFileName())
+
+    assert len(intersect) > 0
+    assert sum(np.sum(counts) for description, counts in intersect.values()) > 0
+    assert native == intersect
@@ -0,0 +1,84 @@
+""" The vectorized test engine must give the same test arrays and adjusted p-values as the scalar one. """
+import numpy as np
+import pytest
+
+from lib.GeneModCount import GeneModCount2
+from lib.StatMagician import StatMagician
+
+GENES = [("GEN1", 60), ("GEN2", 45), ("EMPTY", 30)]
+
+
+def makeDataList(replicates, seed=0):
+    """ Returns treated (even) and control (uneven) samples with zero-count positions, a signal in the treated
+    samples and a gene without any stop in the first control. """
+    rng = np.random.RandomState(seed)
+    dataList = []
+
+    for j in range(2 * replicates):
+        data = {}
+        for name, length in GENES:
+            counts = rng.poisson(3, length)
+            counts[::7] = 0
+            if j % 2 == 0:
+                counts[5] += 40
+            if name == "EMPTY" and j == 1:
+                counts[:] = 0
+
+            gene = GeneModCount2(name, "chrI", "+", "gene", 1, length)
+            gene.countArray = counts
+            gene.calculate_statistics()
+            data["%s_1_%i" % (name, length)] = gene
+        dataList.append(data)
+
+    return dataList
+
+
+def assertSameTestArray(expected, actual):
+    assert len(expected) == len(actual)
+
+    for position, (e, a) in enumerate(zip(expected, actual)):
+        if e == "NA":
+            assert a == "NA", position
+            continue
+
+        # chi, p, adjusted p, OR, lower and upper OR bound, then the raw counts
+        assert len(a) == len(e), position
+        for value, reference in zip(a[:6], e[:6]):
+            if reference == "NA":
+                assert value == "NA", position
+            else:
+                assert value == pytest.approx(reference, rel=1e-9), position
+        assert a[6:] == e[6:], position
+
+
+@pytest.mark.parametrize("replicates", [1, 3])
+@pytest.mark.parametrize("adjustMethod", ["threshold", "rank"])
+@pytest.mark.parametrize("minTotalStops", [0, 10])
+def test_vectorized_matches_scalar(replicates, adjustMethod, minTotalStops):
+    scalar = StatMagician(makeDataList(replicates), 0.05, 1.5, "scalar", adjustMethod,
+                          minTotalStops=minTotalStops).run()
+    vectorized = StatMagician(makeDataList(replicates), 0.05, 1.5, "vectorized", adjustMethod,
+                              minTotalStops=minTotalStops).run()
+
+    assert list(vectorized) == list(scalar)
+    for gene in scalar:
+        assertSameTestArray(scalar[gene].testArray, vectorized[gene].testArray)
+
+
+def test_array_tests_match_table_tests():
+    magic = StatMagician(makeDataList(1), 0.05, 1.5)
+    rng = np.random.RandomState(1)
+
+    # One 2X2 table per row, cells of 1 being clamped zero counts
+    tables = np.vstack([rng.randint(1, 50, (20, 4)), [[1, 1, 1, 1], [1, 500, 1, 3], [40, 1, 1, 200]]]).astype(float)
+    chisq = magic.testChisqArray(tables[:, 0], tables[:, 1], tables[:, 2], tables[:, 3])
+    for i, table in enumerate(tables.tolist()):
+        assert [values[i] for values in chisq] == pytest.approx(magic.testChisq(table), rel=1e-9)
+
+    # Three replicates per position
+    a, b, c, d = [rng.randint(1, 60, (15, 3)).astype(float) for i in range(4)]
+    a[0] = 1
+    cmh = magic.testCMHArray(a, b, c, d)
+    for i in range(len(a)):
+        table = [x for j in range(3) for x in (a[i, j], b[i, j], c[i, j], d[i, j])]
+        assert [values[i] for values in cmh] == pytest.approx(magic.testCMH(table), rel=1e-9)